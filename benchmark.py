@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import parser
+import shared
+from body_store import open_body_store
+from build_author_index import build_authors
+from build_json_tree import build_month_threads
+from build_search_index import build_search_index
+from fixups import apply_fixups
+from make_markdown_files import render
+from mbox import iter_mbox, decode_message
+from output_sink import close_output_sink
+from synthetic_mbox import write_mbox
+from thread_engine import update_threads
+
+
+# Times every stage of the pipeline on synthetic archives of a few sizes and
+# writes the results as JSON. --compare checks them against an earlier
+# results file and exits with 1 if any stage got slower.
+
+
+@contextlib.contextmanager
+def measure(results, stage, trace_memory):
+    # The scripts print as they go, keep that out of the timings
+    if trace_memory:
+        tracemalloc.start()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+    timing = results.setdefault(stage, {})
+    if trace_memory:
+        timing['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        timing['wall_seconds'] = time.perf_counter() - wall
+        timing['cpu_seconds'] = time.process_time() - cpu
+
+
+def clear_caches():
+    # So no size starts with what the previous one parsed and masked
+    for function in (parser.parse_date, shared.mask_email,
+                     shared.make_id_from_email, shared.mask_from):
+        function.cache_clear()
+
+
+def run_stages(results, trace_memory, workers):
+    # Runs in a scratch directory holding grasehotspot/topics.mbox
+    conn = sqlite3.connect('database.db')
+    parser.tune_for_bulk_load(conn)
+    parser.create_tables(conn)
+    store = open_body_store(conn)
+    with measure(results, 'split_mbox', trace_memory):
+        raw_messages = []
+        for offset, length, raw in iter_mbox(parser.MBOX_PATH):
+            with raw:
+                raw_messages.append((bytes(raw), offset, length))
+    with measure(results, 'EmailMessage', trace_memory):
+        for raw, offset, length in raw_messages:
+            parser.EmailMessage(decode_message(raw), offset, length)
+    with measure(results, 'RawEmailMessage', trace_memory):
+        messages = [parser.RawEmailMessage(*raw) for raw in raw_messages]
+    with measure(results, 'get_messages', trace_memory):
+        for _ in parser.get_messages(workers=workers):
+            pass
+    with measure(results, 'apply_fixups', trace_memory):
+        for message in messages:
+            apply_fixups(message)
+    with measure(results, 'insert_into_db', trace_memory):
+        known = parser.KnownMessages()
+        messages = [
+            message for message in messages
+            if known.is_new(parser.MBOX_PATH, message._mbox_offset,
+                            message._mbox_length, message._message_hash)
+        ]
+        for batch in parser.batched(messages, parser.INSERT_BATCH_SIZE):
+            new_messages = parser.insert_into_db(conn, batch)
+            parser.add_to_authors(conn, new_messages)
+            parser.index_for_search(conn, new_messages)
+            for message in new_messages:
+                parser.write_message_to_file(store, message)
+        conn.commit()
+        parser.create_indexes(conn)
+    with measure(results, 'update_threads', trace_memory):
+        update_threads(conn)
+    with measure(results, 'build_json_tree', trace_memory):
+        months = build_month_threads(conn)
+    with measure(results, 'build_author_index', trace_memory):
+        authors = build_authors(conn)
+    with measure(results, 'make_markdown_files', trace_memory):
+        render(conn, months, authors, workers)
+    with measure(results, 'make_markdown_files_unchanged', trace_memory):
+        render(conn, months, authors, workers)
+    with measure(results, 'build_search_index', trace_memory):
+        build_search_index(conn)
+    store.close()
+    conn.close()
+    # Every pass runs in its own directory, with a sink of its own
+    close_output_sink()
+
+
+def benchmark_size(messages, options, workers, trace_memory):
+    results = {}
+    passes = [False, True] if trace_memory else [False]
+    for tracing in passes:
+        work_dir = tempfile.mkdtemp(prefix="benchmark-")
+        cwd = os.getcwd()
+        try:
+            os.makedirs(os.path.join(work_dir, "grasehotspot"))
+            os.chdir(work_dir)
+            write_mbox(parser.MBOX_PATH, messages=messages, **options)
+            clear_caches()
+            run_stages(results, tracing, workers)
+            mbox_bytes = os.path.getsize(parser.MBOX_PATH)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(work_dir)
+    for stage in ('split_mbox', 'get_messages'):
+        results[stage]['bytes_per_second'] = mbox_bytes / results[stage]['wall_seconds']
+    for stage in ('EmailMessage', 'RawEmailMessage', 'get_messages',
+                  'insert_into_db'):
+        results[stage]['messages_per_second'] = messages / results[stage]['wall_seconds']
+    return results
+
+
+def compare(results, baseline, threshold, min_seconds):
+    # Returns the (size, stage, baseline, now) of every stage whose wall time
+    # grew by more than threshold, ignoring differences under min_seconds
+    regressions = []
+    for size, stages in results['sizes'].items():
+        for stage, timing in stages.items():
+            before = baseline['sizes'].get(size, {}).get(stage)
+            if not before:
+                continue
+            old, new = before['wall_seconds'], timing['wall_seconds']
+            if new > old * (1 + threshold) and new - old > min_seconds:
+                regressions.append((size, stage, old, new))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline on synthetic archives"
+    )
+    parser.add_argument(
+        "--sizes", default="500,2000,8000",
+        help="comma separated message counts"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--thread-depth", type=int, default=6)
+    parser.add_argument("--fan-out", type=int, default=4)
+    parser.add_argument(
+        "--body-lines", type=int, nargs=2, default=(0, 20),
+        metavar=("MIN", "MAX")
+    )
+    parser.add_argument("--duplicate-rate", type=float, default=0.02)
+    parser.add_argument("--orphan-rate", type=float, default=0.02)
+    parser.add_argument("--malformed-date-rate", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--no-memory", action="store_true",
+        help="skip the second, tracemalloc pass measuring peak memory"
+    )
+    parser.add_argument(
+        "--output", default="benchmark_results.json",
+        help="where to write the results"
+    )
+    parser.add_argument(
+        "--compare", metavar="BASELINE",
+        help="results file to check this run against"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=0.2,
+        help="slowdown, as a fraction, counted as a regression"
+    )
+    parser.add_argument(
+        "--min-seconds", type=float, default=0.05,
+        help="ignore slowdowns smaller than this"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    options = {
+        'seed': args.seed,
+        'thread_depth': args.thread_depth,
+        'fan_out': args.fan_out,
+        'body_lines': tuple(args.body_lines),
+        'duplicate_rate': args.duplicate_rate,
+        'orphan_rate': args.orphan_rate,
+        'malformed_date_rate': args.malformed_date_rate,
+    }
+    results = {
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'workers': args.workers,
+        'options': options,
+        'sizes': {},
+    }
+    for size in [int(size) for size in args.sizes.split(",")]:
+        print(f"Benchmarking {size} messages")
+        timings = benchmark_size(size, options, args.workers, not args.no_memory)
+        results['sizes'][str(size)] = timings
+        for stage, timing in timings.items():
+            print("  {:<30} {:8.3f}s".format(stage, timing['wall_seconds']))
+    with open(args.output, 'w') as o:
+        o.write(json.dumps(results, indent=2, sort_keys=True))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.loads(f.read())
+        regressions = compare(results, baseline, args.threshold, args.min_seconds)
+        for size, stage, old, new in regressions:
+            print(f"Regression: {stage} at {size} messages took {new:.3f}s, "
+                  f"was {old:.3f}s")
+        if regressions:
+            sys.exit(1)
+        print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+import glob
+import locale
+import mmap
+import os
+import zlib
+
+import instrument
+from output_sink import OutputSink
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Masked message bodies, keyed by message_hash. The directory store is the
+# original raw_messages/<year>/<hash>.txt layout; the other two keep every
+# body in database.db or in one append-only pack file, optionally compressed.
+
+BODY_STORES = ('directory', 'sqlite', 'pack')
+COMPRESSIONS = ('none', 'zlib', 'zstd')
+PACK_PATH = "raw_messages.pack"
+
+
+def compress(data, compression):
+    if compression == 'zlib':
+        return zlib.compress(data)
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def decompress(data, compression):
+    if compression == 'zlib':
+        return zlib.decompress(data)
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+class DirectoryBodyStore(object):
+    # Bodies are written in the background by an OutputSink, which is
+    # flushed before anything reads them
+
+    def __init__(self, root="raw_messages"):
+        self._root = root
+        self._sink = OutputSink()
+
+    def _path(self, message_hash, file_year):
+        return "{}/{}/{}.txt".format(self._root, file_year, message_hash)
+
+    def put(self, message_hash, file_year, text):
+        self._sink.write(
+            self._path(message_hash, file_year),
+            text.encode(locale.getpreferredencoding(False))
+        )
+        instrument.count('files_written')
+
+    def get(self, message_hash, file_year):
+        self._sink.flush()
+        with open(self._path(message_hash, file_year)) as f:
+            return f.read()
+
+    def fingerprint(self, message_hash, file_year):
+        # Changes whenever the body is rewritten
+        self._sink.flush()
+        stat = os.stat(self._path(message_hash, file_year))
+        return stat.st_size, stat.st_mtime_ns
+
+    def clear(self):
+        self._sink.flush()
+        os.makedirs(self._root, exist_ok=True)
+        for f in glob.glob(f'{self._root}/*/*'):
+            os.remove(f)
+
+    def close(self):
+        self._sink.close()
+
+
+class SqliteBodyStore(object):
+
+    def __init__(self, conn, compression='none'):
+        self._conn = conn
+        self._compression = compression
+        conn.cursor().execute('CREATE TABLE IF NOT EXISTS "bodies" ( \
+                `message_hash`	TEXT PRIMARY KEY, \
+                `checksum`	INTEGER, \
+                `body`	BLOB \
+            )')
+
+    def put(self, message_hash, file_year, text):
+        body = compress(text.encode("utf-8"), self._compression)
+        self._conn.cursor().execute(
+            "INSERT OR REPLACE INTO `bodies` VALUES (?, ?, ?);",
+            [message_hash, zlib.crc32(body), body]
+        )
+
+    def get(self, message_hash, file_year):
+        sql = "SELECT `body` FROM `bodies` WHERE `message_hash` = ?;"
+        row = self._conn.cursor().execute(sql, [message_hash]).fetchone()
+        return decompress(row[0], self._compression).decode("utf-8")
+
+    def fingerprint(self, message_hash, file_year):
+        sql = "SELECT `checksum` FROM `bodies` WHERE `message_hash` = ?;"
+        return self._conn.cursor().execute(sql, [message_hash]).fetchone()[0]
+
+    def clear(self):
+        self._conn.cursor().execute("DELETE FROM `bodies`;")
+
+    def close(self):
+        self._conn.commit()
+
+
+class PackBodyStore(object):
+    # Bodies are appended to one pack file, with their offsets kept in
+    # database.db. Reads are a slice of a memory map of the pack.
+
+    def __init__(self, conn, compression='none', path=PACK_PATH):
+        self._conn = conn
+        self._compression = compression
+        self._path = path
+        self._pack = None
+        self._map = None
+        conn.cursor().execute('CREATE TABLE IF NOT EXISTS "body_index" ( \
+                `message_hash`	TEXT PRIMARY KEY, \
+                `offset`	INTEGER, \
+                `length`	INTEGER, \
+                `checksum`	INTEGER \
+            )')
+
+    def put(self, message_hash, file_year, text):
+        body = compress(text.encode("utf-8"), self._compression)
+        if self._pack is None:
+            self._pack = open(self._path, "ab")
+        offset = self._pack.tell()
+        self._pack.write(body)
+        self._conn.cursor().execute(
+            "INSERT OR REPLACE INTO `body_index` VALUES (?, ?, ?, ?);",
+            [message_hash, offset, len(body), zlib.crc32(body)]
+        )
+
+    def _lookup(self, message_hash):
+        sql = """
+            SELECT `offset`, `length`, `checksum`
+            FROM `body_index` WHERE `message_hash` = ?;
+        """
+        return self._conn.cursor().execute(sql, [message_hash]).fetchone()
+
+    def get(self, message_hash, file_year):
+        offset, length, _ = self._lookup(message_hash)
+        if self._pack is not None:
+            self._pack.flush()
+        if self._map is None or len(self._map) < offset + length:
+            if self._map is not None:
+                self._map.close()
+            with open(self._path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        body = self._map[offset:offset + length]
+        return decompress(body, self._compression).decode("utf-8")
+
+    def fingerprint(self, message_hash, file_year):
+        return self._lookup(message_hash)[2]
+
+    def clear(self):
+        if self._pack is not None:
+            self._pack.close()
+            self._pack = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        open(self._path, "wb").close()
+        self._conn.cursor().execute("DELETE FROM `body_index`;")
+
+    def close(self):
+        if self._pack is not None:
+            self._pack.close()
+            self._pack = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._conn.commit()
+
+
+def get_body_store_settings(conn):
+    # Chosen by parser.py and kept with the ingest checkpoint
+    sql = """
+        SELECT `key`, `value` FROM `ingest_state`
+        WHERE `key` IN ('body_store', 'body_compression');
+    """
+    try:
+        settings = dict(conn.cursor().execute(sql).fetchall())
+    except Exception:
+        settings = {}
+    return (
+        settings.get('body_store', 'directory'),
+        settings.get('body_compression', 'none')
+    )
+
+
+def open_body_store(conn, kind=None, compression=None):
+    saved_kind, saved_compression = get_body_store_settings(conn)
+    kind = kind or saved_kind
+    compression = compression or saved_compression
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package")
+    if kind == 'sqlite':
+        return SqliteBodyStore(conn, compression)
+    if kind == 'pack':
+        return PackBodyStore(conn, compression)
+    return DirectoryBodyStore()
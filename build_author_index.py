@@ -1,64 +1,30 @@
 #!/usr/bin/env python
-import sqlite3
-import json
+import argparse
 import glob
+import itertools
 import os
 
+import instrument
+from intermediate import FORMATS, write_records
+
 def get_authors(conn):
+    # parser.py keeps the count of each author's messages in authors
     cursor = conn.cursor()
     sql = """
         SELECT
             `sender_id`,
             `from`,
-            count(*) AS `messages`
-        FROM
             `messages`
-        GROUP BY
-            `sender_id`
+        FROM
+            `authors`
         ORDER BY
-            `messages` DESC;
+            `messages` DESC,
+            `sender_id` ASC;
     """
     for row in cursor.execute(sql):
         yield row[0], row[1], row[2]
 
 
-def make_thread(conn, thread_root):
-    def make_dict(row):
-        return {
-            'message_hash': row[0],
-            'message_id': row[2],
-            'file_year': row[3],
-            'date': row[4],
-            'raw_date': row[5],
-            'from': row[7],
-            'to': row[8],
-            'subject': row[9],
-            'reply_to': row[10],
-            'no_parent': row[11],
-            'children': build_tree(make_dict, conn, row[2])
-        }
-    sql = "SELECT * FROM `messages` WHERE `message_hash` = ?;"
-    try:
-        cursor = conn.cursor()
-        cursor.execute(sql, [thread_root])
-        row = cursor.fetchone()
-        return make_dict(row)
-    except sqlite3.IntegrityError:
-        print("sqlite3.IntegrityError", thread_root)
-        return None
-    except sqlite3.ProgrammingError:
-        print("sqlite3.ProgrammingError", thread_root)
-        return None
-
-
-def build_tree(make_dict, conn, message_id):
-    sql = "SELECT * FROM `messages` WHERE `reply_to` = ? ORDER BY `date` ASC;"
-    children = []
-    for row in conn.cursor().execute(sql, [message_id]):
-        children.append(make_dict(row))
-    return children
-
-
 def make_threads(conn, sender_id):
     sql = """
         SELECT DISTINCT
@@ -70,29 +36,65 @@ def make_threads(conn, sender_id):
         ORDER BY
             `date` ASC
     """
+    # Threads are referenced by their root's message_hash, make_markdown_files
+    # renders each one once and shares it between authors
     threads = []
     for row in conn.cursor().execute(sql, [sender_id]):
-        threads.append(make_thread(conn, row[0]))
+        if row[0] is not None:
+            threads.append(row[0])
     return threads
 
 def clean_the_slate():
     if not os.path.exists("json_authors/"):
         os.makedirs("json_authors/")    
-    for f in glob.glob('json_authors/*.json'):
+    for f in glob.glob('json_authors/*.*'):
         os.remove(f)
 
+def build_authors(conn):
+    # Returns {sender_id: author}, the contents of the json_authors files
+    authors = {}
+    for sender_id, from_email, count in get_authors(conn):
+        instrument.log(sender_id, count, level=2)
+        authors[sender_id] = {
+            'sender_id': sender_id,
+            'from': from_email,
+            'count': count,
+            'threads': make_threads(conn, sender_id)
+        }
+    return authors
+
+
+def write_authors(authors, encoding='jsonl'):
+    # The author first, then a record per thread root
+    for sender_id, author in authors.items():
+        header = {key: author[key] for key in ('sender_id', 'from', 'count')}
+        write_records(
+            'json_authors/{}'.format(sender_id),
+            itertools.chain([header], author['threads']),
+            encoding
+        )
+        instrument.count('files_written')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Write json_authors/")
+    parser.add_argument(
+        "--format", choices=FORMATS, default='jsonl',
+        help="marshal is faster, but only make_markdown_files.py reads it"
+    )
+    instrument.add_arguments(parser)
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
+    instrument.configure(args)
     clean_the_slate()
-    conn = sqlite3.connect('database.db')
-    for sender_id, from_email, count in get_authors(conn):
-        with open('json_authors/{}.json'.format(sender_id), 'w') as o:
-            print(sender_id, count)
-            o.write(json.dumps({
-                'sender_id': sender_id,
-                'from': from_email,
-                'count': count,
-                'threads': make_threads(conn, sender_id)
-            }))
+    conn = instrument.connect('database.db')
+    with instrument.stage('build_author_index'):
+        write_authors(build_authors(conn), args.format)
+    conn.close()
+    instrument.finish(args)
 
 
 if __name__ == "__main__":
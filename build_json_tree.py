@@ -1,19 +1,53 @@
 #!/usr/bin/env python
-import sqlite3
+import argparse
 from datetime import datetime
-import json
 import glob
 import os
 
+import instrument
+from intermediate import FORMATS, write_records
+from model import Archive
+
 def get_message_rows(cursor):
-    sql = "SELECT * FROM `messages` ORDER BY `date` ASC;"
-    for row in cursor.execute(sql):
-        yield row[1], row[3], row[4]
+    sql = """
+        SELECT
+            `message_hash`,
+            `message_id`,
+            `file_year`,
+            `date`,
+            `raw_date`,
+            `from`,
+            `to`,
+            `subject`,
+            `reply_to`,
+            `no_parent`,
+            `thread_root`
+        FROM
+            `messages`
+        ORDER BY
+            `date` ASC,
+            `rowid` ASC;
+    """
+    return cursor.execute(sql)
+
 
+def load_messages(rows):
+    # Returns the values of each message in date order, ordered like
+    # model.COLUMNS, and the thread_root of each
+    messages = []
+    thread_roots = []
+    for row in rows:
+        messages.append(row[:10])
+        thread_roots.append(row[10])
+    return messages, thread_roots
 
-def populate_months(rows):
+
+def populate_months(messages, thread_roots):
+    # Thread roots per month, in order of first appearance. The inner dicts
+    # are used as ordered sets.
     months = {}
-    for thread_root, file_year, date_timestamp in rows:
+    for values, thread_root in zip(messages, thread_roots):
+        file_year, date_timestamp = values[2], values[3]
         if date_timestamp:
             date_obj = datetime.utcfromtimestamp(date_timestamp)
             year, month = date_obj.year, date_obj.month
@@ -22,68 +56,102 @@ def populate_months(rows):
         if year not in months:
             months[year] = {}
         if month not in months[year]:
-            months[year][month] = []
-        if thread_root not in months[year][month]:
-            months[year][month].append(thread_root)
+            months[year][month] = {}
+        months[year][month][thread_root] = None
     return months
 
 
-def build_threads(conn, months):
-    def make_dict(row):
-        return {
-            'message_hash': row[0],
-            'message_id': row[2],
-            'file_year': row[3],
-            'date': row[4],
-            'raw_date': row[5],
-            'from': row[7],
-            'to': row[8],
-            'subject': row[9],
-            'reply_to': row[10],
-            'no_parent': row[11],
-            'children': build_tree(make_dict, conn, row[2])
-        }
+def index_replies(messages):
+    # messages are in date order, so every list of replies is too
+    replies = {}
+    for values in messages:
+        if values[8] is not None:
+            replies.setdefault(values[8], []).append(values)
+    return replies
+
+
+def make_thread_builder(messages):
+    # Returns a function laying out the tree of a thread root as
+    # model.Message records. Each thread is only built once.
+    archive = Archive()
+    messages_by_hash = {values[0]: values for values in messages}
+    replies = index_replies(messages)
+    threads = {}
+
+    def get_replies(message):
+        return replies.get(message.message_id, ())
+
+    def build_thread(thread_root):
+        if thread_root not in threads:
+            if thread_root not in messages_by_hash:
+                instrument.log("Missing thread root", thread_root)
+                return None
+            threads[thread_root] = archive.add_thread(
+                messages_by_hash[thread_root], get_replies
+            )
+        return threads[thread_root]
+
+    return build_thread
+
+
+def build_threads(messages, months):
+    # Returns {(year, month): threads}, keyed the way the json_months files
+    # are named, each thread the root model.Message of its tree
+    build_thread = make_thread_builder(messages)
+    threads_by_month = {}
     for year in list(months.keys()):
         for month in list(months[year].keys()):
             threads_in_month = []
             for thread_root in months[year][month]:
-                sql = "SELECT * FROM `messages` WHERE `message_hash` = ?;"
-                try:
-                    cursor = conn.cursor()
-                    cursor.execute(sql, [thread_root])
-                    row = cursor.fetchone()
-                    threads_in_month.append(make_dict(row))
-                except sqlite3.IntegrityError:
-                    print("sqlite3.IntegrityError", thread_root)
-                except sqlite3.ProgrammingError:
-                    print("sqlite3.ProgrammingError", thread_root)
-            if not os.path.exists(f'json_months/{year}/'):
-                os.makedirs(f'json_months/{year}/')
-            with open('json_months/{}/{}.json'.format(year, month), 'w') as f:
-                f.write(json.dumps(threads_in_month))
-
-
-def build_tree(make_dict, conn, message_id):
-    sql = "SELECT * FROM `messages` WHERE `reply_to` = ? ORDER BY `date` ASC;"
-    children = []
-    cursor = conn.cursor()
-    for row in cursor.execute(sql, [message_id]):
-        children.append(make_dict(row))
-    return children
+                thread = build_thread(thread_root)
+                if thread is not None:
+                    threads_in_month.append(thread)
+            threads_by_month[str(year), str(month)] = threads_in_month
+    return threads_by_month
+
+
+def build_month_threads(conn):
+    messages, thread_roots = load_messages(get_message_rows(conn.cursor()))
+    return build_threads(messages, populate_months(messages, thread_roots))
+
+
+def write_months(threads_by_month, encoding='jsonl'):
+    # A record per thread, so only one is ever encoded at a time
+    for (year, month), threads_in_month in threads_by_month.items():
+        if not os.path.exists(f'json_months/{year}/'):
+            os.makedirs(f'json_months/{year}/')
+        write_records(
+            'json_months/{}/{}'.format(year, month),
+            (thread.to_dict() for thread in threads_in_month),
+            encoding
+        )
+        instrument.count('files_written')
 
 
 def clean_the_slate():
-    for f in glob.glob('json_months/*/*.json'):
+    for f in glob.glob('json_months/*/*.*'):
         os.remove(f)
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Write json_months/")
+    parser.add_argument(
+        "--format", choices=FORMATS, default='jsonl',
+        help="marshal is faster, but only make_markdown_files.py reads it"
+    )
+    instrument.add_arguments(parser)
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
+    instrument.configure(args)
     clean_the_slate()
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    months = populate_months(get_message_rows(cursor))
-    build_threads(conn, months)
+    conn = instrument.connect('database.db')
+    with instrument.stage('build_json_tree'):
+        write_months(build_month_threads(conn), args.format)
     conn.close()
+    instrument.finish(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+import argparse
+import glob
+import itertools
+import json
+import os
+from datetime import datetime
+
+import instrument
+from output_sink import get_output_sink
+from parser import batched, has_search_table
+
+
+# Exports messages_fts, the full text index parser.py fills, as static files
+# a browser can search without loading all of it:
+# - search_index/index.json: how the rest is laid out
+# - search_index/docs/<n>.json: DOCS_PER_SHARD messages each, as
+#   [message_hash, url, subject, sender, date], numbered in date order
+# - search_index/terms/<prefix>.json: every term starting with prefix, the
+#   hex of its first PREFIX_LENGTH characters in UTF-8, mapped to the
+#   numbers of the messages it's in, as the gaps between them
+# Terms are what FTS5's unicode61 tokenizer makes of the text: lower case
+# runs of letters and digits, without diacritics.
+
+SEARCH_INDEX_DIR = "search_index"
+DOCS_PER_SHARD = 1000
+PREFIX_LENGTH = 2
+TOKENIZER = "unicode61 remove_diacritics 1"
+
+
+def get_documents(conn):
+    sql = """
+        SELECT
+            `messages_fts`.`rowid`,
+            `messages`.`message_hash`,
+            `messages`.`date`,
+            `messages`.`file_year`,
+            `messages_fts`.`subject`,
+            `messages_fts`.`sender`
+        FROM
+            `messages_fts`
+            JOIN `messages` USING (`message_hash`)
+        ORDER BY
+            `messages`.`date`,
+            `messages`.`rowid`
+    """
+    return conn.cursor().execute(sql)
+
+
+def get_message_url(message_hash, date, file_year):
+    if date:
+        path = datetime.utcfromtimestamp(date).strftime('%Y/%m')
+    else:
+        path = "{}/unknown".format(file_year)
+    return "/archive/{}/{}".format(path, message_hash)
+
+
+def get_postings(conn):
+    # Yields (term, rowids) in term order, straight from the FTS5 index
+    conn.cursor().execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS temp.`messages_fts_vocab` "
+        "USING fts5vocab(main, messages_fts, instance);"
+    )
+    sql = "SELECT `term`, `doc` FROM temp.`messages_fts_vocab`;"
+    rows = conn.cursor().execute(sql)
+    for term, group in itertools.groupby(rows, key=lambda row: row[0]):
+        yield term, {row[1] for row in group}
+
+
+def get_prefix(term):
+    return term[:PREFIX_LENGTH].encode('utf-8').hex()
+
+
+def write_json(sink, path, value):
+    sink.write(path, json.dumps(value, separators=(',', ':')).encode('utf-8'),
+               skip_identical=True)
+    return path
+
+
+def build_search_index(conn):
+    # Rewrites the files that changed and removes those no longer needed
+    if not has_search_table(conn):
+        instrument.log("There's no messages_fts table, SQLite was built without FTS5")
+        return
+    sink = get_output_sink()
+    written = set()
+    document_numbers = {}
+    for shard, rows in enumerate(batched(get_documents(conn), DOCS_PER_SHARD)):
+        documents = []
+        for rowid, message_hash, date, file_year, subject, sender in rows:
+            document_numbers[rowid] = len(document_numbers)
+            documents.append([
+                message_hash,
+                get_message_url(message_hash, date, file_year),
+                subject,
+                sender,
+                datetime.utcfromtimestamp(date).date().isoformat() if date else None,
+            ])
+        written.add(write_json(sink, f"{SEARCH_INDEX_DIR}/docs/{shard}.json", documents))
+    shards = []
+    for prefix, terms in itertools.groupby(get_postings(conn),
+                                           key=lambda posting: get_prefix(posting[0])):
+        shard = {}
+        for term, rowids in terms:
+            numbers = sorted(document_numbers[rowid] for rowid in rowids)
+            shard[term] = [number - previous for number, previous
+                           in zip(numbers, [0] + numbers)]
+        instrument.log(prefix, len(shard), level=2)
+        written.add(write_json(sink, f"{SEARCH_INDEX_DIR}/terms/{prefix}.json", shard))
+        shards.append(prefix)
+    written.add(write_json(sink, f"{SEARCH_INDEX_DIR}/index.json", {
+        'documents': len(document_numbers),
+        'docs_per_shard': DOCS_PER_SHARD,
+        'prefix_length': PREFIX_LENGTH,
+        'tokenizer': TOKENIZER,
+        'term_shards': shards,
+    }))
+    counts = sink.flush()
+    instrument.count('files_written', counts['written'])
+    removed = 0
+    for path in glob.glob(f"{SEARCH_INDEX_DIR}/*/*.json"):
+        if path not in written:
+            os.remove(path)
+            removed += 1
+    instrument.count('files_removed', removed)
+    instrument.log("Indexed {} messages in {} term shards, wrote {} files, "
+                   "removed {}".format(len(document_numbers), len(shards),
+                                       counts['written'], removed))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Write search_index/")
+    instrument.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    instrument.configure(args)
+    conn = instrument.connect('database.db')
+    with instrument.stage('build_search_index'):
+        build_search_index(conn)
+    conn.close()
+    instrument.finish(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import hashlib
+import json
+
+
+# Corrections for quirks of the archive, applied to each message as it's
+# parsed, before its row and body are written. A rule matches on the raw
+# Date header and the year the message was filed under, and sets any of the
+# fields in FIELDS. Rules are tried in order, each seeing what the ones
+# before it changed, so a field a rule clears won't match later rules.
+#
+# A rule has:
+# - name: for the counters
+# - raw_date_contains: text the Date header must include
+# - file_year_before: the message must be filed under an earlier year
+# - set: {field: value} to change
+#
+# Changing the rules rebuilds the database on the next parser.py run, so
+# every message is corrected by the same ones.
+
+FIELDS = {
+    'raw_date': '_raw_date',
+    'date': '_unixtime',
+    'file_year': '_file_year',
+}
+
+FIXUPS = [
+    {
+        # Filed before 1998 but dated 1999, the date can't be trusted
+        'name': 'weird_1999_dates_between_92_and_97',
+        'raw_date_contains': '1999',
+        'file_year_before': 1998,
+        'set': {'raw_date': None, 'date': None},
+    },
+    {
+        'name': 'genuine_1999_dates',
+        'raw_date_contains': '1999',
+        'set': {'file_year': 1999},
+    },
+]
+
+
+def matches(rule, message):
+    if 'raw_date_contains' in rule:
+        if message._raw_date is None or rule['raw_date_contains'] not in message._raw_date:
+            return False
+    if 'file_year_before' in rule:
+        if message._file_year >= rule['file_year_before']:
+            return False
+    return True
+
+
+def apply_fixups(message, fixups=FIXUPS):
+    # Returns the names of the rules that changed the message
+    applied = []
+    for rule in fixups:
+        if matches(rule, message):
+            for field, value in rule['set'].items():
+                setattr(message, FIELDS[field], value)
+            applied.append(rule['name'])
+    return applied
+
+
+def fixups_fingerprint(fixups=FIXUPS):
+    return hashlib.sha256(
+        json.dumps(fixups, sort_keys=True).encode("utf-8")
+    ).hexdigest()
@@ -0,0 +1,206 @@
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import sqlite3
+import time
+from collections import Counter
+
+
+# Timings and counters shared by all the scripts. Stages nest, and counters
+# and SQL statements are added to every stage running at the time. Pool
+# workers keep their own copies, so what they do is counted by the parent
+# from the results they hand back.
+
+verbosity = 1
+profile_dir = None
+
+_stages = []
+_running = []
+_counters = Counter()
+_sql = {}
+
+
+def log(*values, level=1):
+    # Level 1 is a line or two per stage, level 2 a line per file
+    if verbosity >= level:
+        print(*values)
+
+
+def count(name, amount=1):
+    _counters[name] += amount
+    for record in _running:
+        record['counters'][name] += amount
+
+
+def _record_sql(statement_type, seconds, count=1):
+    for timings in [_sql] + [record['sql'] for record in _running]:
+        timing = timings.setdefault(statement_type, {'count': 0, 'seconds': 0.0})
+        timing['count'] += count
+        timing['seconds'] += seconds
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * 1024
+
+
+@contextlib.contextmanager
+def stage(name):
+    record = {
+        'name': "/".join([running['name'] for running in _running[-1:]] + [name]),
+        'counters': Counter(),
+        'sql': {},
+    }
+    profiler = None
+    if profile_dir and not _running:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    _running.append(record)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        record['wall_seconds'] = time.perf_counter() - wall
+        record['cpu_seconds'] = time.process_time() - cpu
+        record['peak_rss_bytes'] = peak_rss_bytes()
+        _running.pop()
+        _stages.append(record)
+        if profiler:
+            profiler.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(profile_dir, f"{name}.prof"))
+
+
+def get_statement_type(sql):
+    words = sql.split(None, 1)
+    return words[0].rstrip(";").upper() if words else ""
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # Times execute, the fetches and iterating over the rows, against the
+    # statement's first keyword. The time spent on rows is added up and
+    # recorded once they run out, or the cursor is reused or dropped.
+
+    statement_type = None
+    _row_seconds = 0.0
+
+    def _record_rows(self):
+        if self._row_seconds:
+            _record_sql(self.statement_type, self._row_seconds, count=0)
+            self._row_seconds = 0.0
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._row_seconds += time.perf_counter() - start
+            self._record_rows()
+            raise
+        self._row_seconds += time.perf_counter() - start
+        return row
+
+    def __del__(self):
+        self._record_rows()
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            _record_sql(self.statement_type, time.perf_counter() - start)
+
+    def execute(self, sql, *args):
+        self._record_rows()
+        self.statement_type = get_statement_type(sql)
+        return self._timed(super().execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        self._record_rows()
+        self.statement_type = get_statement_type(sql)
+        return self._timed(super().executemany, sql, *args)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
+
+
+def connect(path):
+    return sqlite3.connect(path, factory=InstrumentedConnection)
+
+
+def _rates(record):
+    rates = {}
+    for name in ('messages', 'bytes'):
+        if record['counters'][name] and record['wall_seconds']:
+            rates[f'{name}_per_second'] = record['counters'][name] / record['wall_seconds']
+    return rates
+
+
+def report():
+    return {
+        'stages': [
+            dict(record, counters=dict(record['counters']), **_rates(record))
+            for record in _stages
+        ],
+        'counters': dict(_counters),
+        'sql': _sql,
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+
+def write_report(path):
+    with open(path, 'w') as o:
+        o.write(json.dumps(report(), indent=2, sort_keys=True))
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "-v", "--verbose", action="count", default=0,
+        help="print a line per file written"
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true",
+        help="only print errors"
+    )
+    parser.add_argument(
+        "--report", metavar="PATH",
+        help="write stage timings, counters and SQL statistics as JSON"
+    )
+    parser.add_argument(
+        "--profile", metavar="DIR",
+        help="write a cProfile dump of each top level stage to DIR"
+    )
+
+
+def configure(args):
+    global verbosity, profile_dir
+    verbosity = 0 if args.quiet else 1 + args.verbose
+    profile_dir = args.profile
+
+
+def finish(args):
+    if args.report:
+        write_report(args.report)
@@ -0,0 +1,35 @@
+import json
+import marshal
+
+
+# The json_months and json_authors files are written and read a record at a
+# time: one JSON document per line, or marshal's binary encoding, which is
+# faster but only meant to be read back by these scripts.
+
+FORMATS = ('jsonl', 'marshal')
+
+
+def write_records(path, records, encoding='jsonl'):
+    if encoding == 'marshal':
+        with open(f"{path}.marshal", 'wb') as o:
+            for record in records:
+                marshal.dump(record, o)
+        return
+    with open(f"{path}.jsonl", 'w') as o:
+        for record in records:
+            o.write(json.dumps(record))
+            o.write("\n")
+
+
+def read_records(path):
+    # path includes the extension write_records added
+    if path.endswith('.marshal'):
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    yield marshal.load(f)
+                except EOFError:
+                    return
+    with open(path) as f:
+        for line in f:
+            yield json.loads(line)
@@ -1,11 +1,27 @@
 #!/usr/bin/env python
+import argparse
 import json
 import glob
+import hashlib
+import locale
+import multiprocessing
 import os
 import re
+from collections import Counter, OrderedDict
 from datetime import datetime
-import sqlite3
-from shared import make_id_from_email, mask_from
+import instrument
+import model
+import shared
+from model import Archive
+from body_store import open_body_store
+from build_author_index import build_authors
+from build_json_tree import build_month_threads
+from intermediate import read_records
+from output_sink import get_output_sink
+
+
+MANIFEST_PATH = "render_manifest.json"
+OUTPUT_ENCODING = locale.getpreferredencoding(False)
 
 
 month_file_header = """\
@@ -120,6 +136,82 @@ month_name_map = [
 ]
 
 
+class RenderManifest(object):
+    # Maps each page written to a hash of the inputs it was rendered from.
+    # A page whose inputs hash the same as in the previous run's manifest is
+    # skipped, and a rendered page identical to the file on disk isn't
+    # rewritten, so its mtime is kept. Pages are written by the process's
+    # OutputSink, and only counted as unchanged once flushed.
+
+    def __init__(self, previous_pages):
+        self.previous_pages = previous_pages
+        self.pages = {}
+        self.counts = Counter()
+        self.sink = get_output_sink()
+
+    def is_current(self, path, input_hash):
+        if path in self.pages:
+            # Already dealt with in this run
+            return True
+        self.pages[path] = input_hash
+        if self.previous_pages.get(path) == input_hash and os.path.exists(path):
+            self.counts['skipped'] += 1
+            return True
+        return False
+
+    def write(self, path, text):
+        self.counts['rendered'] += 1
+        self.sink.write(path, text.encode(OUTPUT_ENCODING), skip_identical=True)
+
+    def flush(self):
+        self.counts['unchanged'] += self.sink.flush()['unchanged']
+
+    def merge(self, pages, counts):
+        self.pages.update(pages)
+        self.counts.update(counts)
+
+    def remove_stale_pages(self):
+        removed = 0
+        for path in self.previous_pages:
+            if path not in self.pages and os.path.exists(path):
+                os.remove(path)
+                removed += 1
+        return removed
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST_PATH) as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(pages):
+    with open(MANIFEST_PATH, 'w') as o:
+        o.write(json.dumps(pages, sort_keys=True))
+
+
+def hash_code():
+    # Any change to the renderer, the masking or the thread model
+    # re-renders everything
+    m = hashlib.sha256()
+    for filename in (__file__, shared.__file__, model.__file__):
+        with open(filename, 'rb') as f:
+            m.update(f.read())
+    return m.hexdigest()
+
+
+CODE_HASH = hash_code()
+
+
+def hash_inputs(*inputs):
+    m = hashlib.sha256(CODE_HASH.encode())
+    for value in inputs:
+        m.update(b"\0" + str(value).encode("utf-8"))
+    return m.hexdigest()
+
+
 def escape_chevrons(text):
     if text:
         return text.replace('<', '\\<').replace('>', '\\>')
@@ -129,19 +221,19 @@ def escape_chevrons(text):
 
 def make_back_to_links(thread):
     def get_months(months, message):
-        if not message['date']:
+        if not message.date:
             return []
-        parsed_date = datetime.utcfromtimestamp(message['date'])
+        parsed_date = datetime.utcfromtimestamp(message.date)
         months.add((parsed_date.year, parsed_date.month))
-        for child in message['children']:
+        for child in message.children:
             get_months(months, child)
         return months
     def get_authors(authors, message):
-        sender_id = make_id_from_email(message['from'])
-        authors.add((sender_id, message['from']))
-        for child in message['children']:
+        authors.add((author_names[message.sender][0], message.sender))
+        for child in message.children:
             get_authors(authors, child)
         return authors
+    author_names = get_author_names()
     months = get_months(set(), thread)
     authors = get_authors(set(), thread)
     link_text = ""
@@ -155,51 +247,108 @@ def make_back_to_links(thread):
     link_text += "\n"
     for sender_id, email_from in sorted(authors):
         link_text += "+ Return to \"[{}](/authors/{})\"\n".format(
-            mask_from(email_from),
+            author_names[email_from][1],
             sender_id
         )
     return link_text
 
 
-def create_message_pages(thread, message=None):
+def get_message_page_path(message):
+    if message.date:
+        parsed_date = datetime.utcfromtimestamp(message.date)
+        path = "emails_test/{}".format(parsed_date.strftime('%Y/%m'))
+    else:
+        path = "emails_test/{}/unknown".format(message.file_year)
+    return "{}/{}.md".format(path, message.message_hash)
+
+
+_body_stores = {}
+
+
+def get_body_store():
+    # One store per process, pool workers can't share the parent's connection
+    pid = os.getpid()
+    if pid not in _body_stores:
+        _body_stores[pid] = open_body_store(instrument.connect('database.db'))
+    return _body_stores[pid]
+
+
+_author_names = {}
+
+
+def load_author_names(conn):
+    # Maps each From header to (sender_id, masked for HTML, masked as text),
+    # as parser.py worked them out
+    sql = """
+        SELECT
+            `from`,
+            `sender_id`,
+            `masked_from_html`,
+            `masked_from_text`
+        FROM
+            `author_aliases`;
+    """
+    return {row[0]: row[1:] for row in conn.cursor().execute(sql)}
+
+
+def get_author_names():
+    # Loaded once per process, like the body store
+    pid = os.getpid()
+    if pid not in _author_names:
+        _author_names[pid] = load_author_names(instrument.connect('database.db'))
+    return _author_names[pid]
+
+
+def create_message_pages(thread, manifest, owned, thread_hash, get_fragments,
+                         message=None):
+    # Writes the pages of the messages in owned, unless the thread and the
+    # stored body are the same as last time
     if not message:
         message = thread
-    if message['date']:
-        parsed_date = datetime.utcfromtimestamp(message['date'])
-        path = "emails_test/{}/".format(parsed_date.strftime('%Y/%m'))
+    if message.message_hash in owned:
+        path = get_message_page_path(message)
+        input_hash = hash_inputs(
+            thread_hash,
+            message.message_hash,
+            get_body_store().fingerprint(
+                message.message_hash, message.file_year
+            )
+        )
+        if not manifest.is_current(path, input_hash):
+            manifest.write(path, make_message_page(message, get_fragments(thread)))
+    for child in message.children:
+        create_message_pages(thread, manifest, owned, thread_hash,
+                             get_fragments, child)
+
+
+def make_message_page(message, fragments):
+    if message.date:
+        parsed_date = datetime.utcfromtimestamp(message.date)
         iso_date = parsed_date.date().isoformat()
         utc_formatted_date = parsed_date.strftime('%Y-%m-%d %H:%M:%S UTC')
-        raw_date = message["raw_date"]
+        raw_date = message.raw_date
     else:
-        path = "emails_test/{}/unknown/".format(message['file_year'])
         iso_date = "(Unknown Date)"
         utc_formatted_date = "(Unknown Date)"
         raw_date = "_N/A_"
-    if not os.path.exists(path):
-        os.makedirs(path)
-    thread_tree = make_markdown_thread_tree(thread, message["message_hash"])
-    with open("raw_messages/{}/{}.txt".format(
-        message['file_year'], message["message_hash"]
-    )) as f:
-        raw_message = "{% raw  %}" + f.read() + "{% endraw %}"
-    with open("{}/{}.md".format(path, message["message_hash"]), "w") as o:
-        o.write(message_page_template.format(
-            f"{iso_date} - {message['subject']}",
-            iso_date,
-            message["subject"],
-            escape_chevrons(mask_from(message["from"], '@')),
-            #escape_chevrons(message["to"]),
-            message["message_hash"],
-            escape_chevrons(message["message_id"]),
-            escape_chevrons(message["reply_to"]),
-            utc_formatted_date,
-            raw_date,
-            raw_message,
-            make_back_to_links(thread),
-            thread_tree
-        ))
-    for child in message["children"]:
-        create_message_pages(thread, child)
+    thread_tree = make_markdown_thread_tree(fragments, message.message_hash)
+    body = get_body_store().get(message.message_hash, message.file_year)
+    raw_message = "{% raw  %}" + body + "{% endraw %}"
+    return message_page_template.format(
+        f"{iso_date} - {message.subject}",
+        iso_date,
+        message.subject,
+        escape_chevrons(get_author_names()[message.sender][2]),
+        #escape_chevrons(message.to),
+        message.message_hash,
+        escape_chevrons(message.message_id),
+        escape_chevrons(message.reply_to),
+        utc_formatted_date,
+        raw_date,
+        raw_message,
+        fragments['back_links'],
+        thread_tree
+    )
 
 
 def make_thread_list_item(message, offset, show_link=True):
@@ -209,148 +358,455 @@ def make_thread_list_item(message, offset, show_link=True):
             formatted_date,
             message_hash
         )
-    if message['date']:
-        parsed_date = datetime.utcfromtimestamp(message['date'])
+    if message.date:
+        parsed_date = datetime.utcfromtimestamp(message.date)
         path = parsed_date.strftime('%Y/%m')
         iso_date = parsed_date.date().isoformat()
     else:
-        path = str(message['file_year']) + "/unknown"
+        path = str(message.file_year) + "/unknown"
         iso_date = "(Unknown Date)"
     if show_link:
         subject = make_link(
-            message['subject'],
+            message.subject,
             path,
-            message['message_hash']
+            message.message_hash
         )
     else:
-        subject = message['subject']
+        subject = message.subject
     return "{}+ {} ({}) - {} - _{}_\n".format(
         "  " * offset,
         iso_date,
-        message['raw_date'],
+        message.raw_date,
         subject,
-        escape_chevrons(mask_from(message['from'], '@'))
+        escape_chevrons(get_author_names()[message.sender][2])
     )
 
 
-def make_markdown_thread_tree(message, message_hash=None, offset=0):
-    show_link = message_hash != message['message_hash']
-    if message['no_parent']:
-        text = "+ _Unknown thread root_\n"
-        offset += 1
-    else:
-        text = ""
-    text += make_thread_list_item(message, offset, show_link)
-    for child in message['children']:
-        text += make_markdown_thread_tree(child, message_hash, offset + 1)
-    return text
+def make_thread_fragments(thread):
+    # Everything the pages of a thread share, worked out once per thread:
+    # the back links, and each list item of the tree with and without its
+    # link.
+    items = []
+
+    def add_items(message, offset):
+        if message.no_parent:
+            prefix = "+ _Unknown thread root_\n"
+            offset += 1
+        else:
+            prefix = ""
+        items.append((
+            message.message_hash,
+            prefix + make_thread_list_item(message, offset),
+            prefix + make_thread_list_item(message, offset, False)
+        ))
+        for child in message.children:
+            add_items(child, offset + 1)
 
+    add_items(thread, 0)
+    return {
+        'back_links': make_back_to_links(thread),
+        'items': items,
+    }
+
+
+def make_markdown_thread_tree(fragments, message_hash=None):
+    # The message being viewed, if any, is the one shown without a link
+    return "".join(
+        unlinked if item_hash == message_hash else linked
+        for item_hash, linked, unlinked in fragments['items']
+    )
 
-def make_markdown_thread(thread):
+
+def make_markdown_thread(thread, fragments=None):
+    if not fragments:
+        fragments = make_thread_fragments(thread)
     return "### {}\n{}".format(
-        thread['subject'],
-        make_markdown_thread_tree(thread)
+        thread.subject,
+        make_markdown_thread_tree(fragments)
     )
 
 
-def build_threads_by_month():
-    for filename in glob.glob('json_months/*/*.json'):
-        print(filename)
-        with open(filename) as f:
-            threads = json.loads(f.read())
-        regex = "json_months/([0-9]+)/([0-9]+|unknown).json"
-        matches = re.match(regex, filename)
-        year, month = matches.group(1), matches.group(2)
-        if not os.path.exists("threads_test/{}/".format(year)):
-            os.makedirs("threads_test/{}/".format(year))
-        with open('threads_test/{}/{}.md'.format(
-            year,
-            month.zfill(2)
-        ), 'w') as o:
-            if month != "unknown":
-                month_name = month_name_map[int(month) - 1]
+def get_month_key(date, file_year):
+    # The (year, month) a message is listed under
+    if date:
+        parsed_date = datetime.utcfromtimestamp(date)
+        return str(parsed_date.year), str(parsed_date.month)
+    return str(file_year), "unknown"
+
+
+def list_thread_messages(month_key):
+    def add_hashes(message, hashes):
+        hashes.append(message.message_hash)
+        for child in message.children:
+            add_hashes(child, hashes)
+        return hashes
+    return month_key, [
+        (
+            thread.message_hash,
+            add_hashes(thread, []),
+            hash_inputs(json.dumps(thread.to_dict(), sort_keys=True))
+        )
+        for thread in _shared['months'][month_key]
+    ]
+
+
+def survey_months(months, workers=1):
+    # One quick pass over every month before rendering, finding:
+    # - owned_pages: which (month, thread) writes each message page. A
+    #   thread spanning several months is in each of them, and a reply to a
+    #   duplicated Message-ID is listed under every copy, so the same page
+    #   can come up many times. Whichever came last in month order used to
+    #   win, so it's handed to that one and written once.
+    # - thread_hashes: a hash of each thread, the input of its pages
+    # - thread_months: a month each thread can be found in
+    # - month_roots: the roots of each month's threads, in order
+    _share({'months': months})
+    listed = dict(map_with_workers(list_thread_messages, months, workers,
+                                   _share, ({'months': months},)))
+    owners = {}
+    thread_hashes = {}
+    thread_months = {}
+    month_roots = {}
+    for month_key in months:
+        month_roots[month_key] = [thread_root for thread_root, _, _ in listed[month_key]]
+        for thread_root, message_hashes, thread_hash in listed[month_key]:
+            thread_hashes[thread_root] = thread_hash
+            thread_months[thread_root] = month_key
+            for message_hash in message_hashes:
+                owners[message_hash] = (month_key, thread_root)
+    owned_pages = {}
+    for message_hash, owner in owners.items():
+        owned_pages.setdefault(owner, set()).add(message_hash)
+    return {
+        'owned_pages': owned_pages,
+        'thread_hashes': thread_hashes,
+        'thread_months': thread_months,
+        'month_roots': month_roots,
+    }
+
+
+def render_month(month_key):
+    # Writes one month page and the message pages its threads own, skipping
+    # those whose inputs haven't changed. Returns the Markdown of the threads
+    # it had to render, keyed by root, and what it did to the manifest.
+    # The threads are gone through once, so a month read from a file only
+    # ever has one of them in memory.
+    year, month = month_key
+    instrument.log(year, month, level=2)
+    manifest = RenderManifest(_shared['previous_pages'])
+    rendered_threads = {}
+    fragments = {}
+
+    def get_fragments(thread):
+        if thread.message_hash not in fragments:
+            fragments.clear()
+            fragments[thread.message_hash] = make_thread_fragments(thread)
+        return fragments[thread.message_hash]
+
+    path = 'threads_test/{}/{}.md'.format(year, month.zfill(2))
+    input_hash = hash_inputs(year, month, *[
+        _shared['thread_hashes'][thread_root]
+        for thread_root in _shared['month_roots'][month_key]
+    ])
+    text = None
+    if not manifest.is_current(path, input_hash):
+        if month != "unknown":
+            month_name = month_name_map[int(month) - 1]
+        else:
+            month_name = "(unknown month)"
+        text = month_file_header.format(
+            f"{month_name} {year}",
+            month_name,
+            year
+        )
+    for thread in _shared['months'][month_key]:
+        create_message_pages(
+            thread,
+            manifest,
+            _shared['owned_pages'].get((month_key, thread.message_hash), ()),
+            _shared['thread_hashes'][thread.message_hash],
+            get_fragments
+        )
+        if text is not None:
+            rendered_threads[thread.message_hash] = make_markdown_thread(
+                thread, get_fragments(thread)
+            )
+            text += rendered_threads[thread.message_hash] + "\n"
+    if text is not None:
+        manifest.write(path, text)
+    manifest.flush()
+    return rendered_threads, manifest.pages, manifest.counts
+
+
+def build_threads_by_month(manifest, months, survey, workers=1):
+    # Returns the Markdown of the threads it rendered keyed by root
+    rendered_threads = {}
+    shared = dict(survey, months=months, previous_pages=manifest.previous_pages)
+    _share(shared)
+    results = map_with_workers(render_month, months, workers,
+                               _share, (shared,))
+    for rendered, pages, counts in results:
+        rendered_threads.update(rendered)
+        manifest.merge(pages, counts)
+    return rendered_threads
+
+
+def build_years_index(manifest, month_keys):
+    years = sorted({int(year) for year, _ in month_keys})
+    for year in years:
+        instrument.log(year, level=2)
+        # "unknown" comes first, as in month_order
+        months = sorted(
+            [month for month_year, month in month_keys if month_year == str(year)],
+            key=lambda month: month_order((year, month))
+        )
+        path = '_years/{}.md'.format(year)
+        if manifest.is_current(path, hash_inputs(year, *months)):
+            continue
+        text = years_index_template.format(year)
+        for month_number in months:
+            instrument.log(year, month_number, level=2)
+            if month_number != "unknown":
+                month_name = month_name_map[int(month_number) - 1]
             else:
                 month_name = "(unknown month)"
-            o.write(month_file_header.format(
-                f"{month_name} {year}",
-                month_name,
-                year
-            ))
-            for thread in threads:
-                create_message_pages(thread)
-                o.write(make_markdown_thread(thread))
-                o.write("\n")
-
-
-def build_years_index():
-    if not os.path.exists("_years"):
-        os.makedirs("_years")
-    years_filenames = glob.glob('json_months/*')
-    years = sorted([int(re.match("json_months/([0-9]+)", year_filename).group(1)) for year_filename in glob.glob('json_months/*')])
-    for year in years:
-        print(year)
-        with open('_years/{}.md'.format(year), 'w') as o:
-            o.write(years_index_template.format(year))
-            months = sorted([re.match('json_months/([0-9]+)/([0-9]+|unknown).json', month_filename).group(2) for month_filename in glob.glob('json_months/{}/*.json'.format(year))], key=int) 
-            for month_number in months:
-                print(year, month_number)
-                if month_number != "unknown":
-                    month_name = month_name_map[int(month_number) - 1]
-                else:
-                    month_name = "(unknown month)"
-                o.write('+ [{}](/archive/{}/{})'.format(month_name, year, month_number.zfill(2)))
-                o.write("\n")
-
-
-
-def build_author_indices():
-    if not os.path.exists("authors_test/"):
-        os.makedirs("authors_test/")
-    for filename in glob.glob('json_authors/*.json'):
-        print(filename)
-        with open(filename) as f:
-            author = json.loads(f.read())
-        with open('authors_test/{}.md'.format(author['sender_id']), 'w') as o:
-            o.write(author_file_header.format(
-                author['sender_id'],
-                author['count'],
-                mask_from(author['from']),
-                author['count'],
-                "posts" if author['count'] > 1 else "post"
-            ))
-            for thread in author['threads']:
-                o.write(make_markdown_thread(thread))
-                o.write("\n")
-    conn = sqlite3.connect('database.db')
+            text += '+ [{}](/archive/{}/{})'.format(month_name, year, month_number.zfill(2))
+            text += "\n"
+        manifest.write(path, text)
+
+
+# The months whose threads get_rendered_thread rendered last, so author
+# pages don't keep every skipped month's Markdown for the whole run
+LAZY_MONTHS_KEPT = 24
+_lazily_rendered_months = OrderedDict()
+
+
+def get_rendered_thread(thread_root):
+    # Threads from months that were skipped get rendered when an author page
+    # needs them, a month at a time
+    if thread_root in _shared['rendered_threads']:
+        return _shared['rendered_threads'][thread_root]
+    month_key = _shared['thread_months'][thread_root]
+    if month_key in _lazily_rendered_months:
+        _lazily_rendered_months.move_to_end(month_key)
+    else:
+        _lazily_rendered_months[month_key] = {
+            thread.message_hash: make_markdown_thread(thread)
+            for thread in _shared['months'][month_key]
+        }
+        if len(_lazily_rendered_months) > LAZY_MONTHS_KEPT:
+            _lazily_rendered_months.popitem(last=False)
+    return _lazily_rendered_months[month_key][thread_root]
+
+
+def render_author(sender_id):
+    instrument.log(sender_id, level=2)
+    manifest = RenderManifest(_shared['previous_pages'])
+    author = _shared['authors'][sender_id]
+    path = 'authors_test/{}.md'.format(sender_id)
+    input_hash = hash_inputs(sender_id, author['from'], author['count'], *[
+        _shared['thread_hashes'][thread_root] for thread_root in author['threads']
+    ])
+    if not manifest.is_current(path, input_hash):
+        text = author_file_header.format(
+            author['sender_id'],
+            author['count'],
+            get_author_names()[author['from']][1],
+            author['count'],
+            "posts" if author['count'] > 1 else "post"
+        )
+        for thread_root in author['threads']:
+            text += get_rendered_thread(thread_root) + "\n"
+        manifest.write(path, text)
+    manifest.flush()
+    return manifest.pages, manifest.counts
+
+
+def build_author_indices(conn, manifest, months, authors, survey,
+                         rendered_threads, workers=1):
+    shared = dict(
+        survey,
+        months=months,
+        authors=authors,
+        previous_pages=manifest.previous_pages,
+        rendered_threads=rendered_threads
+    )
+    _share(shared)
+    results = map_with_workers(render_author, authors, workers,
+                               _share, (shared,))
+    for pages, counts in results:
+        manifest.merge(pages, counts)
     cursor = conn.cursor()
     sql = """
         SELECT
-            `from`,
+            `masked_from_html`,
             `sender_id`,
-            count(*) AS `messages`
-        FROM
             `messages`
-        GROUP BY
-            `sender_id`
+        FROM
+            `authors`
         ORDER BY
-            `messages` DESC;
+            `messages` DESC,
+            `sender_id` ASC;
     """
-    if not os.path.exists("authors_index/"):
-        os.makedirs("authors_index/")    
-    with open('author_index/authors.md', 'w') as o:
-        o.write(author_index_template)
-        for row in cursor.execute(sql):
-            o.write("+ [{}](/authors/{}/) - _{} posts_\n".format(
-                mask_from(row[0]),
-                row[1],
-                row[2],
-            ))
+    rows = cursor.execute(sql).fetchall()
+    path = 'author_index/authors.md'
+    if manifest.is_current(path, hash_inputs(*rows)):
+        return
+    text = author_index_template
+    for row in rows:
+        text += "+ [{}](/authors/{}/) - _{} posts_\n".format(
+            row[0],
+            row[1],
+            row[2],
+        )
+    manifest.write(path, text)
+
+
+# Read only state for render_month and render_author, set in the parent and
+# handed to pool workers through _share
+_shared = {}
+
+
+def _share(values):
+    _shared.update(values)
+
+
+def map_with_workers(function, items, workers, initializer=None, initargs=()):
+    if workers == 1:
+        yield from map(function, items)
+        return
+    with multiprocessing.Pool(workers, initializer, initargs) as pool:
+        yield from pool.imap_unordered(function, items)
+
+
+def make_output_dirs(conn, month_keys):
+    # Everything is created up front so parallel workers never race to make
+    # the same directory
+    dirs = {"_years", "authors_test", "author_index"}
+    for year, _ in month_keys:
+        dirs.add("threads_test/{}".format(year))
+    sql = "SELECT DISTINCT `date`, `file_year` FROM `messages`;"
+    for date, file_year in conn.cursor().execute(sql):
+        year, month = get_month_key(date, file_year)
+        if month == "unknown":
+            dirs.add("emails_test/{}/unknown".format(year))
+        else:
+            dirs.add("emails_test/{}/{}".format(year, month.zfill(2)))
+    for path in dirs:
+        os.makedirs(path, exist_ok=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Render the Markdown pages")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="processes rendering months and authors, 0 for one per CPU"
+    )
+    instrument.add_arguments(parser)
+    return parser.parse_args()
+
+
+class MonthFile(object):
+    # The threads of a json_months file, read a thread at a time each time
+    # it's iterated over instead of all being kept in memory
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        for thread in read_records(self.path):
+            yield Archive().add_thread_dict(thread)
+
+
+def load_months():
+    # The json_months files written by build_json_tree.py, in either format
+    months = {}
+    for filename in glob.glob('json_months/*/*.*'):
+        matches = re.match(
+            r"json_months/([0-9]+)/([0-9]+|unknown)\.(jsonl|marshal)$", filename
+        )
+        if matches:
+            months[matches.group(1), matches.group(2)] = MonthFile(filename)
+    return months
+
+
+def load_authors():
+    # The json_authors files written by build_author_index.py: the author,
+    # then the root of each of their threads
+    authors = {}
+    for filename in glob.glob('json_authors/*.*'):
+        records = read_records(filename)
+        author = next(records)
+        author['threads'] = list(records)
+        authors[author['sender_id']] = author
+    return authors
+
+
+def month_order(month_key):
+    year, month = month_key
+    return int(year), 0 if month == "unknown" else int(month)
+
+
+def render(conn, months, authors, workers=1):
+    # months maps (year, month) to its threads, the root model.Message of
+    # each, as build_json_tree.py lists them, or a MonthFile of them. authors
+    # maps sender_id to what build_author_index.py lists.
+    # Months are put in calendar order, which decides the thread a message
+    # listed in several threads gets its page from; it used to depend on the
+    # order the filesystem listed json_months in.
+    months = dict(sorted(months.items(), key=lambda item: month_order(item[0])))
+    _body_stores[os.getpid()] = open_body_store(conn)
+    _author_names[os.getpid()] = load_author_names(conn)
+    _lazily_rendered_months.clear()
+    make_output_dirs(conn, months)
+    manifest = RenderManifest(load_manifest())
+    with instrument.stage('survey'):
+        survey = survey_months(months, workers)
+    with instrument.stage('months'):
+        rendered_threads = build_threads_by_month(manifest, months, survey,
+                                                  workers)
+    with instrument.stage('years'):
+        build_years_index(manifest, months)
+        manifest.flush()
+    with instrument.stage('authors'):
+        build_author_indices(conn, manifest, months, authors, survey,
+                             rendered_threads, workers)
+    manifest.flush()
+    removed = manifest.remove_stale_pages()
+    save_manifest(manifest.pages)
+    # Workers count in their own process, so this comes from the manifest
+    instrument.count('files_written',
+                     manifest.counts['rendered'] - manifest.counts['unchanged'])
+    instrument.count('files_removed', removed)
+    instrument.log("Rendered {} pages ({} identical to the existing file), "
+                   "skipped {} unchanged, removed {}".format(
+                       manifest.counts['rendered'],
+                       manifest.counts['unchanged'],
+                       manifest.counts['skipped'],
+                       removed
+                   ))
 
 
 def main():
-    build_threads_by_month()
-    build_years_index()
-    build_author_indices()
+    args = parse_args()
+    instrument.configure(args)
+    workers = args.workers or os.cpu_count()
+    conn = instrument.connect('database.db')
+    with instrument.stage('make_markdown_files'):
+        # pipeline.py only writes json_months and json_authors with --json.
+        # Rendering nothing would remove every page, so without them the
+        # threads and authors come from database.db instead.
+        months = load_months()
+        if not months:
+            instrument.log("No json_months, building the threads from database.db")
+            months = build_month_threads(conn)
+        authors = load_authors()
+        if not authors:
+            instrument.log("No json_authors, building the authors from database.db")
+            authors = build_authors(conn)
+        render(conn, months, authors, workers)
+    conn.close()
+    instrument.finish(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+import bz2
+import gzip
+import locale
+import lzma
+import mmap
+import os
+import re
+
+
+separator_regex = re.compile(rb"From \d+@xxx")
+# Compressed mboxes are decompressed as they're read, offsets into them are
+# offsets into the decompressed text
+compressed_openers = {
+    '.gz': gzip.open,
+    '.xz': lzma.open,
+    '.bz2': bz2.open,
+}
+
+
+def _find_from_line(mm, position):
+    found = mm.find(b"\nFrom ", position)
+    return found if found == -1 else found + 1
+
+
+def split_mbox(mm, start=0):
+    # Yields (offset, length, view) for every message in the mapped mbox from
+    # the byte offset start onwards, which should be the beginning of a line.
+    # The view is a zero-copy slice of the map, so release it (or use it as a
+    # context manager) before asking for the next one.
+    view = memoryview(mm)
+    try:
+        if mm[start:start + 5] == b"From ":
+            position = start
+        else:
+            position = _find_from_line(mm, start)
+        while position != -1:
+            line_end = mm.find(b"\n", position)
+            line_end = len(mm) if line_end == -1 else line_end + 1
+            if separator_regex.match(mm, position, line_end):
+                if position > start:
+                    yield start, position - start, view[start:position]
+                start = line_end
+            position = _find_from_line(mm, line_end - 1)
+        if len(mm) > start:
+            yield start, len(mm) - start, view[start:]
+    finally:
+        view.release()
+
+
+def split_mbox_stream(f, start=0):
+    # split_mbox for a file that can only be read front to back, a line at a
+    # time. The views are of a copy of each message.
+    if start:
+        f.seek(start)
+    position = message_start = start
+    lines = []
+    for line in f:
+        if line.startswith(b"From ") and separator_regex.match(line):
+            if lines:
+                yield message_start, position - message_start, memoryview(b"".join(lines))
+            lines = []
+            message_start = position + len(line)
+        else:
+            lines.append(line)
+        position += len(line)
+    if lines:
+        yield message_start, position - message_start, memoryview(b"".join(lines))
+
+
+def is_compressed(path):
+    return os.path.splitext(path)[1] in compressed_openers
+
+
+def open_mbox(path):
+    return compressed_openers.get(os.path.splitext(path)[1], open)(path, "rb")
+
+
+def iter_mbox(path, start=0):
+    if is_compressed(path):
+        with open_mbox(path) as f:
+            yield from split_mbox_stream(f, start)
+        return
+    mm = map_mbox(path)
+    if mm is None:
+        return
+    with mm:
+        yield from split_mbox(mm, start)
+
+
+def map_mbox(path):
+    # The map stays valid after the file is closed
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def decode_message(raw):
+    # Match what reading the mbox in text mode used to produce, so message
+    # hashes stay stable: locale encoding plus universal newlines.
+    text = str(raw, locale.getpreferredencoding(False))
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def read_raw_message(path, offset, length):
+    with open_mbox(path) as f:
+        f.seek(offset)
+        return f.read(length)
@@ -0,0 +1,95 @@
+# The messages and thread trees of the archive, as __slots__ records instead
+# of a dict per message. Every thread tree is a run of records in
+# Archive.nodes, each reply list a contiguous range of it. A message listed
+# under several parents (a reply to a duplicated Message-ID) gets a record
+# under each, sharing the same values.
+
+COLUMNS = (
+    'message_hash',
+    'message_id',
+    'file_year',
+    'date',
+    'raw_date',
+    'from',
+    'to',
+    'subject',
+    'reply_to',
+    'no_parent',
+)
+
+
+class Message(object):
+
+    __slots__ = ('message_hash', 'message_id', 'file_year', 'date',
+                 'raw_date', 'sender', 'to', 'subject', 'reply_to',
+                 'no_parent', '_nodes', '_start', '_end')
+
+    def __init__(self, values, nodes):
+        # values is one per COLUMNS, in that order
+        (self.message_hash, self.message_id, self.file_year, self.date,
+         self.raw_date, self.sender, self.to, self.subject, self.reply_to,
+         self.no_parent) = values
+        self._nodes = nodes
+        self._start = self._end = 0
+
+    @property
+    def children(self):
+        return self._nodes[self._start:self._end]
+
+    def values(self):
+        return (self.message_hash, self.message_id, self.file_year, self.date,
+                self.raw_date, self.sender, self.to, self.subject,
+                self.reply_to, self.no_parent)
+
+    def to_dict(self):
+        # The layout of json_months
+        values = dict(zip(COLUMNS, self.values()))
+        values['children'] = [child.to_dict() for child in self.children]
+        return values
+
+
+class Archive(object):
+
+    __slots__ = ('nodes',)
+
+    def __init__(self):
+        self.nodes = []
+
+    def _add_replies(self, message, replies):
+        message._start = len(self.nodes)
+        self.nodes.extend(Message(values, self.nodes) for values in replies)
+        message._end = len(self.nodes)
+        return self.nodes[message._start:message._end]
+
+    def add_thread(self, root, get_replies):
+        # Lays out the tree under root, the values of a message, with
+        # get_replies(message) giving the values of its replies in order. A
+        # reply that is already one of its own ancestors, which only a loop
+        # of duplicated Message-IDs can cause, is left out. Returns the root.
+        root_message = Message(root, self.nodes)
+        self.nodes.append(root_message)
+        pending = [(root_message, (root[0],))]
+        while pending:
+            message, ancestors = pending.pop()
+            replies = [
+                values for values in get_replies(message)
+                if values[0] not in ancestors
+            ]
+            for reply in self._add_replies(message, replies):
+                pending.append((reply, ancestors + (reply.message_hash,)))
+        return root_message
+
+    def add_thread_dict(self, thread):
+        # The reverse of Message.to_dict, for threads read from json_months
+        def get_values(values):
+            return tuple(values[key] for key in COLUMNS)
+        root_message = Message(get_values(thread), self.nodes)
+        self.nodes.append(root_message)
+        pending = [(root_message, thread)]
+        while pending:
+            message, values = pending.pop()
+            replies = self._add_replies(
+                message, [get_values(child) for child in values['children']]
+            )
+            pending.extend(zip(replies, values['children']))
+        return root_message
@@ -0,0 +1,141 @@
+import collections
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Writes the many small output files from a few threads, so rendering
+# doesn't wait on each one. Every file is written to a temporary name beside
+# it and renamed into place, so a half written page is never seen. Errors are
+# collected and raised by flush, once everything queued before it is done.
+
+WRITER_THREADS = 4
+# Beyond this many queued files, write waits for the oldest, so a slow disk
+# can't make the queue hold every page of a run
+MAX_PENDING = 256
+
+
+class OutputSink(object):
+
+    def __init__(self, threads=WRITER_THREADS, max_pending=MAX_PENDING):
+        self._threads = threads
+        self._max_pending = max_pending
+        self._executor = None
+        self._pid = None
+        self._pending = collections.deque()
+        self._made_dirs = set()
+        self._dirs_lock = threading.Lock()
+        self._counts = Counter()
+        self._errors = []
+
+    def _make_dir(self, directory, again=False):
+        # Keyed on the absolute path, a relative one means something else
+        # after a chdir
+        directory = os.path.abspath(directory)
+        with self._dirs_lock:
+            if again:
+                self._made_dirs.discard(directory)
+            elif directory in self._made_dirs:
+                return
+        os.makedirs(directory, exist_ok=True)
+        with self._dirs_lock:
+            self._made_dirs.add(directory)
+
+    def _write_file(self, path, data):
+        temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            with open(temp_path, 'wb') as o:
+                o.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _write(self, path, data, skip_identical):
+        if skip_identical:
+            try:
+                with open(path, 'rb') as f:
+                    if f.read() == data:
+                        return 'unchanged'
+            except FileNotFoundError:
+                pass
+        directory = os.path.dirname(path) or "."
+        self._make_dir(directory)
+        try:
+            self._write_file(path, data)
+        except FileNotFoundError:
+            # The directory was removed since it was made
+            self._make_dir(directory, again=True)
+            self._write_file(path, data)
+        return 'written'
+
+    def _collect(self, future):
+        try:
+            self._counts[future.result()] += 1
+        except OSError as e:
+            self._errors.append(e)
+
+    def _check_process(self):
+        # A pool worker forked from a process using the sink has none of its
+        # threads, nor any business with what it queued
+        if self._pid != os.getpid():
+            self._executor = None
+            self._pid = os.getpid()
+            self._pending.clear()
+            self._counts = Counter()
+            self._errors = []
+
+    def write(self, path, data, skip_identical=False):
+        # Queues data, bytes, to be written to path. With skip_identical a
+        # file already holding exactly data is left alone.
+        self._check_process()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self._threads)
+        while len(self._pending) >= self._max_pending:
+            self._collect(self._pending.popleft())
+        self._pending.append(
+            self._executor.submit(self._write, path, data, skip_identical)
+        )
+
+    def flush(self):
+        # Waits for every queued file. Returns how many were written and how
+        # many left unchanged since the last flush.
+        self._check_process()
+        while self._pending:
+            self._collect(self._pending.popleft())
+        counts, self._counts = self._counts, Counter()
+        errors, self._errors = self._errors, []
+        if errors:
+            raise OSError("Could not write {} files, the first: {}".format(
+                len(errors), errors[0]
+            )) from errors[0]
+        return counts
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._executor:
+                self._executor.shutdown()
+            self._executor = None
+
+
+_output_sinks = {}
+
+
+def get_output_sink():
+    # One sink per process, like the body store
+    pid = os.getpid()
+    if pid not in _output_sinks:
+        _output_sinks[pid] = OutputSink()
+    return _output_sinks[pid]
+
+
+def close_output_sink():
+    # Waits for this process's sink and drops it, the next get_output_sink
+    # starts afresh
+    sink = _output_sinks.pop(os.getpid(), None)
+    if sink is not None:
+        sink.close()
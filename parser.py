@@ -1,28 +1,94 @@
 #!/usr/bin/env python
-from email.parser import Parser
+from email.parser import BytesHeaderParser, BytesParser, Parser
 from email import policy
+import argparse
+import calendar
 import email
-import os
+from collections import Counter
+import functools
 import glob
+import locale
+import multiprocessing
+import os
 import re
 import sqlite3
 import dateutil.parser
+from datetime import datetime, timedelta, timezone
 import hashlib
 import pprint
+import traceback
+
+import instrument
+from fixups import apply_fixups, fixups_fingerprint
+from shared import mask_all_emails, mask_from, make_id_from_email
+from thread_engine import update_threads
+from mbox import (
+    iter_mbox, decode_message, is_compressed, map_mbox, read_raw_message
+)
+from body_store import (
+    BODY_STORES, COMPRESSIONS, get_body_store_settings, open_body_store
+)
+
+
+MBOX_PATH = "grasehotspot/topics.mbox"
+# bytes hashes the raw message and only parses its headers, decoding the body
+# from its declared charset when it's written. text is the original way,
+# decoding the whole message with the locale encoding first.
+PARSE_MODES = ('bytes', 'text')
+LOCALE_IS_UTF8 = locale.getpreferredencoding(False).lower().replace("-", "") == "utf8"
+INSERT_BATCH_SIZE = 500
+# A compressed mbox read in parallel comes back this many messages at a
+# time, with at most COMPRESSED_CHUNKS_AHEAD chunks waiting for the parent
+COMPRESSED_CHUNK_SIZE = 64
+COMPRESSED_CHUNKS_AHEAD = 4
+# Changed whenever what messages_fts holds does, so it's rebuilt
+SEARCH_TABLE_VERSION = '2'
+INDEXED_COLUMNS = ('message_id', 'reply_to', 'thread_root', 'sender_id')
 
-from shared import mask_all_emails
+tzinfos = {
+    'EST': -18000,
+    'EDT': -14400,
+    'CST': -21600,
+    'CDT': -18000,
+    'MST': -25200,
+    'MDT': -21600,
+    'PST': -28800,
+    'PPE': -25200,  # See note in README.md
+    'PDT': -25200,
+}
+month_numbers = {
+    name: number for number, name in enumerate([
+        'jan', 'feb', 'mar', 'apr', 'may', 'jun',
+        'jul', 'aug', 'sep', 'oct', 'nov', 'dec'
+    ], 1)
+}
+rfc2822_date_regex = re.compile(
+    r"\s*(?:[A-Za-z]{3},\s*)?(\d{1,2})\s+([A-Za-z]{3})\s+(\d{4})"
+    r"\s+(\d{1,2}):(\d{2})(?::(\d{2}))?\s+([+-])(\d{2})(\d{2})"
+    r"(?: \(([A-Z]{2,5})\))?\s*$"
+)
+utc_zone_names = ('UTC', 'GMT')
+# Zone names dateutil reads as a label for the numeric offset before them
+offset_zone_names = frozenset("""
+    BST CET CEST EET EEST WET WEST MET MEST MEZ MESZ AEST AEDT ACST ACDT
+    AWST JST IST HKT SGT NZST NZDT KST MSK HST AKST AKDT BRT BRST ART CAT
+    EAT WAT SAST PHT ICT WIB NST NDT AST ADT CLT COT PET
+""".split())
 
 
 class EmailMessage(object):
 
-    def __init__(self, raw_text):
-        m = hashlib.sha256()
-        m.update(raw_text.encode("utf-8"))
-        self._message_hash = m.hexdigest()
+    def __init__(self, raw_text, mbox_offset=None, mbox_length=None,
+                 mbox_file=None):
+        self._message_hash = hash_raw_text(raw_text)
         #self._raw_text = raw_text
         parsed_message = Parser(policy=policy.default).parsestr(raw_text, headersonly=False)        
         body = parsed_message.get_body(preferencelist=('plain', 'html')).get_content()
         self._raw_text = body
+        self._masked_text = mask_all_emails(body)
+        self._read_headers(parsed_message, mbox_offset, mbox_length, mbox_file)
+
+    def _read_headers(self, parsed_message, mbox_offset, mbox_length, mbox_file):
         self._raw_date = parsed_message['Date']
         self._parsed_date = self._parse_date_info(self._raw_date)
         self._file_year = self._parsed_date.year
@@ -32,27 +98,12 @@ class EmailMessage(object):
         self._to = parsed_message['To']
         self._subject = parsed_message['Subject']
         self._reply_to = parsed_message['In-Reply-To']
+        self._mbox_offset = mbox_offset
+        self._mbox_length = mbox_length
+        self._mbox_file = mbox_file
 
     def _parse_date_info(self, raw_date):
-        tzinfos = {
-            'EST': -18000,
-            'EDT': -14400,
-            'CST': -21600,
-            'CDT': -18000,
-            'MST': -25200,
-            'MDT': -21600,
-            'PST': -28800,
-            'PPE': -25200,  # See note in README.md
-            'PDT': -25200,
-        }
-        try:
-            return dateutil.parser.parse(raw_date, tzinfos=tzinfos)
-        except ValueError:
-            found = re.search("SMTPSun, (.*) for karn", raw_date)
-            if found is not None:
-                return dateutil.parser.parse(found.group(1), tzinfos=tzinfos)
-            else:
-                return dateutil.parser.parse(raw_date.upper(), tzinfos=tzinfos)
+        return parse_date(raw_date)
 
     def _get_unixtime_from_parsed(self, parsed_date):
         # Don't judge me
@@ -60,16 +111,137 @@ class EmailMessage(object):
             tzoffset = parsed_date.utcoffset().total_seconds()
         except AttributeError:
             tzoffset = 0
-        offset_1970 = parsed_date.strftime("%s")
+        # Read the wall clock fields as UTC, which is what strftime("%s")
+        # gave on a UTC machine, so the result no longer depends on the
+        # local timezone.
+        offset_1970 = calendar.timegm(parsed_date.timetuple())
         # Times are an hour out, don't know why, added an hour to compensate
         return (60 * 60) + int(offset_1970) - int(tzoffset)
 
 
-def clean_the_slate(conn):
-    if not os.path.exists("raw_messages/"):
-        os.makedirs("raw_messages/")
-    for f in glob.glob('raw_messages/*/*'):
-        os.remove(f)
+class RawEmailMessage(EmailMessage):
+    # An EmailMessage from the raw bytes, with only the headers parsed. The
+    # body is parsed and decoded the first time it's asked for, so a
+    # duplicate never is.
+
+    def __init__(self, raw, mbox_offset=None, mbox_length=None,
+                 mbox_file=None, message_hash=None):
+        # Newlines as text mode reads them, or CRLF mboxes keep \r in bodies
+        raw = normalise_newlines(raw)
+        self._raw = raw
+        self._message_hash = message_hash or hash_raw_bytes(raw)
+        self._headers = BytesHeaderParser(policy=policy.default).parsebytes(raw)
+        self._read_headers(self._headers, mbox_offset, mbox_length, mbox_file)
+        self._body = None
+        self._masked_body = None
+
+    @property
+    def _raw_text(self):
+        if self._body is None:
+            parsed_message = self._headers
+            if parsed_message.get_content_maintype() != 'text':
+                # Only a full parse splits out the parts
+                parsed_message = BytesParser(policy=policy.default).parsebytes(self._raw)
+            self._body = parsed_message.get_body(
+                preferencelist=('plain', 'html')
+            ).get_content()
+        return self._body
+
+    @property
+    def _masked_text(self):
+        if self._masked_body is None:
+            self._masked_body = mask_all_emails(self._raw_text)
+        return self._masked_body
+
+    def read_body(self):
+        # Decodes the body now, dropping the raw message
+        self._masked_text
+        self._raw = self._headers = None
+
+
+@functools.lru_cache(maxsize=8192)
+def parse_date(raw_date):
+    # Well formed RFC 2822 dates skip dateutil, giving the same answer it
+    # would. Only four digit years are taken, as dateutil guesses the century
+    # of two digit ones. Like dateutil, a "(PST)" style zone name after the
+    # offset wins over it when it's one of ours, and anything unusual is left
+    # for dateutil to deal with.
+    found = rfc2822_date_regex.match(raw_date)
+    if found is not None:
+        (day, month, year, hour, minute, second,
+         sign, tz_hours, tz_minutes, tz_name) = found.groups()
+        month = month_numbers.get(month.lower())
+        offset = timedelta(hours=int(tz_hours), minutes=int(tz_minutes))
+        if sign == "-":
+            offset = -offset
+        if tz_name in tzinfos:
+            offset = timedelta(seconds=tzinfos[tz_name])
+        elif tz_name in utc_zone_names:
+            offset = timedelta(0)
+        elif tz_name is not None and tz_name not in offset_zone_names:
+            month = None
+        if month and abs(offset) < timedelta(hours=24):
+            try:
+                return datetime(
+                    int(year), month, int(day),
+                    int(hour), int(minute), int(second or 0),
+                    tzinfo=timezone(offset)
+                )
+            except ValueError:
+                pass
+    return parse_date_with_dateutil(raw_date)
+
+
+def parse_date_with_dateutil(raw_date):
+    try:
+        return dateutil.parser.parse(raw_date, tzinfos=tzinfos)
+    except ValueError:
+        found = re.search("SMTPSun, (.*) for karn", raw_date)
+        if found is not None:
+            return dateutil.parser.parse(found.group(1), tzinfos=tzinfos)
+        else:
+            return dateutil.parser.parse(raw_date.upper(), tzinfos=tzinfos)
+
+
+def hash_raw_text(raw_text):
+    m = hashlib.sha256()
+    m.update(raw_text.encode("utf-8"))
+    return m.hexdigest()
+
+
+def hash_raw_bytes(raw):
+    # hash_raw_text of the message as text mode decodes it, without decoding
+    # it when that would give the same bytes back. Messages that aren't valid
+    # UTF-8, which text mode can't read at all, are hashed as they are.
+    if not LOCALE_IS_UTF8:
+        return hash_raw_text(decode_message(raw))
+    return hashlib.sha256(normalise_newlines(raw)).hexdigest()
+
+
+def normalise_newlines(raw):
+    # Universal newlines, on bytes
+    if b"\r" in raw:
+        raw = raw.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    return raw
+
+
+def clean_the_slate(conn, store):
+    create_tables(conn)
+    drop_indexes(conn)
+    # Also empty wherever the last run kept its bodies, if that was elsewhere
+    open_body_store(conn).clear()
+    store.clear()
+    conn.cursor().execute("DELETE FROM messages;")
+    conn.cursor().execute("DELETE FROM ingest_state;")
+    conn.cursor().execute("DELETE FROM mbox_checkpoints;")
+    conn.cursor().execute("DELETE FROM authors;")
+    conn.cursor().execute("DELETE FROM author_aliases;")
+    if has_search_table(conn):
+        conn.cursor().execute("DELETE FROM messages_fts;")
+    conn.commit()
+
+
+def create_tables(conn):
     conn.cursor().execute('CREATE TABLE IF NOT EXISTS "messages" ( \
         	`message_hash`	TEXT NOT NULL UNIQUE, \
             `thread_root`	TEXT, \
@@ -82,25 +254,293 @@ def clean_the_slate(conn):
             `to`	TEXT, \
             `subject`	TEXT, \
             `reply_to`	TEXT, \
-            `no_parent`	INTEGER \
+            `no_parent`	INTEGER, \
+            `mbox_offset`	INTEGER, \
+            `mbox_length`	INTEGER, \
+            `mbox_file`	TEXT \
         )')
-    conn.cursor().execute("DELETE FROM messages;")
+    add_missing_columns(conn, {
+        'mbox_offset': 'INTEGER',
+        'mbox_length': 'INTEGER',
+        'mbox_file': 'TEXT',
+    })
+    conn.cursor().execute('CREATE TABLE IF NOT EXISTS "ingest_state" ( \
+            `key`	TEXT PRIMARY KEY, \
+            `value`	TEXT \
+        )')
+    conn.cursor().execute('CREATE TABLE IF NOT EXISTS "mbox_checkpoints" ( \
+            `mbox_file`	TEXT PRIMARY KEY, \
+            `mbox_offset`	INTEGER, \
+            `mbox_length`	INTEGER, \
+            `message_hash`	TEXT \
+        )')
+    # Every sender and each From header they used, masked once here rather
+    # than by every page that shows them
+    conn.cursor().execute('CREATE TABLE IF NOT EXISTS "authors" ( \
+            `sender_id`	TEXT PRIMARY KEY, \
+            `from`	TEXT, \
+            `masked_from_html`	TEXT, \
+            `masked_from_text`	TEXT, \
+            `messages`	INTEGER \
+        )')
+    conn.cursor().execute('CREATE TABLE IF NOT EXISTS "author_aliases" ( \
+            `from`	TEXT PRIMARY KEY, \
+            `sender_id`	TEXT, \
+            `masked_from_html`	TEXT, \
+            `masked_from_text`	TEXT \
+        )')
+    create_search_table(conn)
     conn.commit()
 
 
-def get_messages():
-    stringbuffer = ""
-    with open("grasehotspot/topics.mbox") as f:
-        for line in f:
-            if re.match("From \d+\@xxx", line):
-                if stringbuffer:
-                    yield EmailMessage(stringbuffer)
-                stringbuffer = ""
-            else:
-                stringbuffer += line
+def create_search_table(conn):
+    # Needs SQLite built with FTS5, without it nothing is searchable
+    try:
+        conn.cursor().execute('CREATE VIRTUAL TABLE IF NOT EXISTS "messages_fts" USING fts5( \
+                `message_hash` UNINDEXED, \
+                `subject`, \
+                `sender`, \
+                `body` \
+            )')
+    except sqlite3.OperationalError:
+        pass
+
+
+def has_search_table(conn):
+    sql = "SELECT 1 FROM `sqlite_master` WHERE `name` = 'messages_fts';"
+    return conn.cursor().execute(sql).fetchone() is not None
+
+
+def has_messages(conn):
+    return conn.cursor().execute("SELECT 1 FROM `messages` LIMIT 1;").fetchone() is not None
+
+
+def search_table_is_complete(conn):
+    # Databases loaded before there was a search table have nothing in it
+    messages = conn.cursor().execute("SELECT count(*) FROM `messages`;").fetchone()[0]
+    indexed = conn.cursor().execute("SELECT count(*) FROM `messages_fts`;").fetchone()[0]
+    return messages == indexed
+
+
+def authors_are_complete(conn):
+    # Databases loaded before there was an authors table have nothing in it
+    messages = conn.cursor().execute("SELECT count(*) FROM `messages`;").fetchone()[0]
+    counted = conn.cursor().execute("SELECT total(`messages`) FROM `authors`;").fetchone()[0]
+    return messages == counted
+
+
+def add_missing_columns(conn, columns):
+    # Databases created before a column was added keep working
+    existing = [row[1] for row in conn.execute("PRAGMA table_info(`messages`)")]
+    for name, column_type in columns.items():
+        if name not in existing:
+            conn.cursor().execute(
+                f"ALTER TABLE `messages` ADD COLUMN `{name}` {column_type}"
+            )
+
+
+def expand_mbox_paths(patterns):
+    # Each pattern is a path or a glob, whose matches are taken in sorted
+    # order. A message in several of them is kept from the first.
+    paths = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+_worker_mboxes = {}
+
 
+class KnownMessages(object):
+    # The hash of every message in the database and every one read so far,
+    # so a message seen before is skipped before any parsing. Also keeps the
+    # last message read from each mbox, new or not, for its checkpoint.
+
+    def __init__(self, message_hashes=()):
+        self.hashes = set(message_hashes)
+        self.duplicates = 0
+        self.last_read = {}
+
+    def is_new(self, path, offset, length, message_hash):
+        self.last_read[path] = (offset, length, message_hash)
+        if message_hash in self.hashes:
+            self.duplicates += 1
+            return False
+        self.hashes.add(message_hash)
+        return True
+
+
+def load_known_messages(conn):
+    sql = "SELECT `message_hash` FROM `messages`;"
+    return KnownMessages(row[0] for row in conn.cursor().execute(sql))
+
+
+def make_message(raw, offset, length, path, parse_mode='bytes',
+                 message_hash=None):
+    if parse_mode == 'text':
+        return EmailMessage(decode_message(raw), offset, length, path)
+    return RawEmailMessage(bytes(raw), offset, length, path, message_hash)
+
+
+def _parse_span(span):
+    # Uncompressed mboxes are mapped by each worker. Bodies are decoded here
+    # too, rather than by the parent.
+    path, offset, length, raw, message_hash, parse_mode = span
+    if raw is None:
+        if path not in _worker_mboxes:
+            _worker_mboxes[path] = map_mbox(path)
+        raw = _worker_mboxes[path][offset:offset + length]
+    message = make_message(raw, offset, length, path, parse_mode, message_hash)
+    if parse_mode == 'bytes':
+        message.read_body()
+    return message
+
+
+def _read_compressed_mbox(queue, path, start, parse_mode, known_hashes):
+    # A compressed mbox can only be read front to back, so a process of its
+    # own decompresses, splits and hashes all of it, parsing the messages
+    # that aren't in known_hashes or earlier in the file. It puts lists of up
+    # to COMPRESSED_CHUNK_SIZE (offset, length, message_hash, message) on
+    # queue, the message None when it was skipped, then None once done.
+    # Copies in earlier files are only known to the parent, which drops them.
+    # With known_hashes None, every message is parsed.
+    try:
+        seen = set()
+        chunk = []
+        for offset, length, raw in iter_mbox(path, start):
+            with raw:
+                raw = bytes(raw)
+            message_hash = hash_raw_bytes(raw)
+            message = None
+            if known_hashes is None or (message_hash not in known_hashes
+                                        and message_hash not in seen):
+                seen.add(message_hash)
+                message = _parse_span((path, offset, length, raw, message_hash, parse_mode))
+            chunk.append((offset, length, message_hash, message))
+            if len(chunk) == COMPRESSED_CHUNK_SIZE:
+                queue.put(chunk)
+                chunk = []
+        queue.put(chunk)
+        queue.put(None)
+    except Exception:
+        queue.put(RuntimeError("Reading {} failed:\n{}".format(
+            path, traceback.format_exc()
+        )))
+
+
+def get_new_raw_messages(paths, starts, known):
+    # Yields (path, offset, length, raw, message_hash) of the messages that
+    # aren't known, all of them when known is None
+    for path in paths:
+        for offset, length, raw in iter_mbox(path, starts.get(path, 0)):
+            with raw:
+                raw = bytes(raw)
+            message_hash = hash_raw_bytes(raw)
+            if known is None or known.is_new(path, offset, length, message_hash):
+                yield path, offset, length, raw, message_hash
+
+
+def get_messages(paths=(MBOX_PATH,), workers=1, starts=None,
+                 parse_mode='bytes', known=None):
+    # starts maps a path to the offset to read it from, if not the beginning.
+    # With known, a KnownMessages, messages it has seen are left out.
+    starts = starts or {}
+    if workers == 1:
+        raw_messages = get_new_raw_messages(paths, starts, known)
+        for path, offset, length, raw, message_hash in raw_messages:
+            yield make_message(raw, offset, length, path, parse_mode, message_hash)
+        return
+    # Compressed mboxes are each read by a process of their own, up to one
+    # per worker at a time, and handed back a chunk at a time through a
+    # bounded queue. Uncompressed ones are split and hashed here, cheaply
+    # through a map, and their messages parsed by the pool. Either way the
+    # results are merged back in file order, so the first copy of a message
+    # is the one kept and the caller stays the only writer.
+    compressed = [path for path in paths if is_compressed(path)]
+    reading = {}
+    readers = []
+
+    def read_next():
+        if compressed:
+            path = compressed.pop(0)
+            queue = multiprocessing.Queue(COMPRESSED_CHUNKS_AHEAD)
+            reader = multiprocessing.Process(
+                target=_read_compressed_mbox,
+                args=(queue, path, starts.get(path, 0), parse_mode,
+                      known.hashes if known is not None else None),
+                daemon=True
+            )
+            reader.start()
+            readers.append(reader)
+            reading[path] = (reader, queue)
 
-def insert_into_db(conn, message):
+    try:
+        with multiprocessing.Pool(workers) as pool:
+            for _ in range(workers):
+                read_next()
+            for path in paths:
+                if not is_compressed(path):
+                    spans = (
+                        (path, offset, length, None, message_hash, parse_mode)
+                        for _, offset, length, _, message_hash
+                        in get_new_raw_messages([path], starts, known)
+                    )
+                    yield from pool.imap(_parse_span, spans, 64)
+                    continue
+                reader, queue = reading.pop(path)
+                read_next()
+                for chunk in iter(queue.get, None):
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    for offset, length, message_hash, message in chunk:
+                        if known is None or known.is_new(path, offset, length,
+                                                         message_hash):
+                            yield message
+                reader.join()
+    finally:
+        for reader in readers:
+            if reader.is_alive():
+                reader.terminate()
+                reader.join()
+
+
+def get_checkpoints(conn):
+    sql = "SELECT `mbox_file`, `mbox_offset`, `mbox_length`, `message_hash` FROM `mbox_checkpoints`;"
+    return {row[0]: row[1:] for row in conn.cursor().execute(sql)}
+
+
+def save_checkpoints(conn, last_read):
+    # last_read has the (offset, length, message_hash) of the last message
+    # read from each mbox
+    sql = "INSERT OR REPLACE INTO `mbox_checkpoints` VALUES (?, ?, ?, ?);"
+    conn.cursor().executemany(sql, [
+        (path, offset, length, message_hash)
+        for path, (offset, length, message_hash) in last_read.items()
+    ])
+    conn.commit()
+
+
+def find_resume_offsets(conn, paths):
+    # Returns where the unparsed tail of each mbox starts, or None when the
+    # checkpoints don't describe these files any more and a full rebuild is
+    # due. An mbox without a checkpoint is new, and read from the start.
+    checkpoints = get_checkpoints(conn)
+    if not checkpoints or not set(checkpoints) <= set(paths):
+        return None
+    starts = {}
+    for path, (offset, length, message_hash) in checkpoints.items():
+        if not os.path.exists(path):
+            return None
+        raw = read_raw_message(path, offset, length)
+        if len(raw) != length or hash_raw_bytes(raw) != message_hash:
+            return None
+        starts[path] = offset + length
+    return starts
+
+
+def message_params(message):
     def process_possible_unicode(text):
         return str(text)
         try:
@@ -108,6 +548,26 @@ def insert_into_db(conn, message):
         except UnicodeDecodeError:
             return str(text)
 
+    return [
+        message._message_hash,
+        message._message_id,
+        message._file_year,
+        message._unixtime,
+        message._raw_date,
+        make_id_from_email(process_possible_unicode(message._from)),
+        process_possible_unicode(message._from),
+        process_possible_unicode(message._to) if message._to else None,
+        process_possible_unicode(message._subject),
+        message._reply_to,
+        message._mbox_offset,
+        message._mbox_length,
+        message._mbox_file
+    ]
+
+
+def insert_into_db(conn, messages):
+    # Inserts a batch of new messages, returning the ones that went in.
+    # Duplicates are left out before this, by KnownMessages.
     sql = """
         INSERT INTO messages (
             `message_hash`,
@@ -115,177 +575,279 @@ def insert_into_db(conn, message):
             `file_year`,
             `date`,
             `raw_date`,
+            `sender_id`,
             `from`,
             `to`,
             `subject`,
-            `reply_to`
+            `reply_to`,
+            `mbox_offset`,
+            `mbox_length`,
+            `mbox_file`
         ) VALUES (
-            ?, ?, ?, ?, ?, ?, ?, ?, ?
+            ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
         )
     """
-    params = [
-        message._message_hash,
-        message._message_id,
-        message._file_year,
-        message._unixtime,
-        message._raw_date,
-        process_possible_unicode(message._from),
-        process_possible_unicode(message._to) if message._to else None,
-        process_possible_unicode(message._subject),
-        message._reply_to
-    ]
+    rows = [message_params(message) for message in messages]
+    inserted = messages
+    cursor = conn.cursor()
+    if not conn.in_transaction:
+        # The whole load is one transaction, committed by the caller
+        cursor.execute("BEGIN;")
+    cursor.execute("SAVEPOINT `batch`;")
     try:
-        conn.cursor().execute(sql, params)
-    except sqlite3.IntegrityError:
-        pass
+        cursor.executemany(sql, rows)
     except sqlite3.ProgrammingError:
-        pprint.pprint(params)
+        # Find the offending rows one at a time
+        cursor.execute("ROLLBACK TO `batch`;")
+        inserted = []
+        for message, params in zip(messages, rows):
+            try:
+                cursor.execute(sql, params)
+                inserted.append(message)
+            except sqlite3.ProgrammingError:
+                pprint.pprint(params)
+    cursor.execute("RELEASE `batch`;")
+    return inserted
 
 
-def write_message_to_file(message):
-    if not os.path.exists(f"raw_messages/{message._file_year}"):
-        os.makedirs(f"raw_messages/{message._file_year}")
+def add_to_authors(conn, messages):
+    # Counts a batch of new messages in authors, adding any sender or From
+    # header not seen before. An author is shown by the From header of their
+    # first message.
+    aliases = {}
+    firsts = {}
+    counts = Counter()
+    for message in messages:
+        from_text = str(message._from)
+        if from_text not in aliases:
+            aliases[from_text] = make_id_from_email(from_text)
+        sender_id = aliases[from_text]
+        firsts.setdefault(sender_id, from_text)
+        counts[sender_id] += 1
+    conn.cursor().executemany(
+        "INSERT OR IGNORE INTO `author_aliases` VALUES (?, ?, ?, ?);",
+        [
+            (from_text, sender_id, mask_from(from_text), mask_from(from_text, '@'))
+            for from_text, sender_id in aliases.items()
+        ]
+    )
+    sql = """
+        INSERT INTO `authors` VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (`sender_id`) DO UPDATE SET
+            `messages` = `messages` + excluded.`messages`;
+    """
+    conn.cursor().executemany(sql, [
+        (sender_id, from_text, mask_from(from_text), mask_from(from_text, '@'),
+         counts[sender_id])
+        for sender_id, from_text in firsts.items()
+    ])
 
-    with open("raw_messages/{}/{}.txt".format(
-        message._file_year, message._message_hash
-    ), "w") as f:
-        f.write(mask_all_emails(message._raw_text))
 
+def index_for_search(conn, messages):
+    # Only ever masked text: the body as stored, the subject with every
+    # address in it masked and the sender masked as the pages show it.
+    # mask_all_emails would miss addresses like bob@localhost.
+    def mask(header):
+        return mask_all_emails(str(header)) if header else None
 
-def mark_replies_with_no_parent(conn):
-    # The OR condition's messages have reply_tos to non-unique message IDs
-    # Also, it's clear by looking at the subjects of the reply_tos and the
-    # message_ids they correspond to, they're all orphans.
-    sql = """
-        UPDATE
-            `messages`
-        SET
-            `no_parent` = 1
-        WHERE
-            (
-                `reply_to` IS NOT NULL
-                AND `reply_to` NOT IN (
-                    SELECT `message_id` FROM `messages`
-                )
-            )
-            OR `reply_to` IN (
-                SELECT
-                    `message_id`
-                FROM
-                    `messages`
-                GROUP BY
-                    `message_id`
-                HAVING
-                    count(`message_id`) > 1
-            );
-    """
-    conn.cursor().execute(sql)
-    conn.commit()
+    sql = "INSERT INTO `messages_fts` VALUES (?, ?, ?, ?);"
+    conn.cursor().executemany(sql, [
+        (
+            message._message_hash,
+            mask(message._subject),
+            mask_from(str(message._from), '@'),
+            message._masked_text
+        )
+        for message in messages
+    ])
 
 
-def fix_weird_1999_dates_between_92_and_97(conn):
-    sql = """
-        UPDATE
-            `messages`
-        SET
-            `raw_date` = NULL,
-            `date` = NULL
-        WHERE
-            `file_year` < 1998
-            AND `raw_date` LIKE "%1999%"
-    """
-    conn.cursor().execute(sql)
-    conn.commit()
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
-def fix_genuine_1999_dates(conn):
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT
-            `file_year`, `message_hash`
-        FROM
-            `messages`
-        WHERE
-            `raw_date` LIKE '%1999%'
-    """)
-    for row in cursor.fetchall():
-        os.rename(
-            "raw_messages/{}/{}.txt".format(row[0], row[1]),
-            "raw_messages/1999/{}.txt".format(row[1])
+def tune_for_bulk_load(conn):
+    # database.db can always be rebuilt from the mbox, so trade durability
+    # for load speed
+    conn.execute("PRAGMA journal_mode = MEMORY;")
+    conn.execute("PRAGMA synchronous = OFF;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA cache_size = -65536;")
+
+
+def create_indexes(conn):
+    for column in INDEXED_COLUMNS:
+        conn.cursor().execute(
+            f"CREATE INDEX IF NOT EXISTS `messages_{column}` ON `messages` (`{column}`);"
         )
-    sql = """
-        UPDATE
-            `messages`
-        SET
-            `file_year` = 1999
-        WHERE
-            `raw_date` LIKE '%1999%'
-    """
-    conn.cursor().execute(sql)
     conn.commit()
 
 
-def calculate_thread_roots(conn):
-    sql = """
-        UPDATE
-            `messages`
-        SET
-            `thread_root` = `message_hash`
-        WHERE
-            `reply_to` IS NULL
-            OR `no_parent` = 1;
-    """
-    cursor = conn.cursor()
-    cursor.execute(sql)
+def drop_indexes(conn):
+    for column in INDEXED_COLUMNS:
+        conn.cursor().execute(f"DROP INDEX IF EXISTS `messages_{column}`;")
     conn.commit()
-    affected_rows = -1
-    i = 0
-    while affected_rows:
-        i += 1
-        print(f"Calculating thread_roots, iteration: {i}")
-        sql = """
-            UPDATE
-                `messages`
-            SET
-                `thread_root` = (
-                    SELECT
-                        `thread_root`
-                    FROM
-                        `messages` AS `messages2`
-                    WHERE
-                        `messages2`.`message_id` = `messages`.`reply_to`
-                )
-            WHERE
-                `reply_to` IN (
-                    SELECT
-                        `message_id`
-                    FROM
-                        `messages`
-                    WHERE
-                        `thread_root` IS NOT NULL
-                )
-                AND `no_parent` IS NULL
-                AND `thread_root` IS NULL
-        """
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        affected_rows = cursor.rowcount
-        print(f"Affected Rows: {affected_rows}")
+
+
+def write_message_to_file(store, message):
+    instrument.count('bodies_written')
+    store.put(message._message_hash, message._file_year, message._masked_text)
+
+
+def get_parse_mode(conn):
+    sql = "SELECT `value` FROM `ingest_state` WHERE `key` = 'parse_mode';"
+    row = conn.cursor().execute(sql).fetchone()
+    return row[0] if row else None
+
+
+def get_fixups_fingerprint(conn):
+    sql = "SELECT `value` FROM `ingest_state` WHERE `key` = 'fixups';"
+    row = conn.cursor().execute(sql).fetchone()
+    return row[0] if row else None
+
+
+def get_search_table_version(conn):
+    sql = "SELECT `value` FROM `ingest_state` WHERE `key` = 'search_table_version';"
+    row = conn.cursor().execute(sql).fetchone()
+    return row[0] if row else None
+
+
+def save_ingest_settings(conn, kind, compression, parse_mode):
+    sql = "INSERT OR REPLACE INTO `ingest_state` (`key`, `value`) VALUES (?, ?);"
+    conn.cursor().executemany(sql, [
+        ('body_store', kind),
+        ('body_compression', compression),
+        ('parse_mode', parse_mode),
+        ('fixups', fixups_fingerprint()),
+        ('search_table_version', SEARCH_TABLE_VERSION),
+    ])
     conn.commit()
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load the mbox into database.db")
+    parser.add_argument(
+        "mboxes", nargs="*", default=[MBOX_PATH],
+        help="mbox files or globs of them, optionally .gz, .xz or .bz2, "
+             "defaults to " + MBOX_PATH
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="processes used to parse messages, 0 for one per CPU"
+    )
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="only parse messages appended since the last run"
+    )
+    parser.add_argument(
+        "--body-store", choices=BODY_STORES,
+        help="where message bodies are kept, defaults to the last run's "
+             "choice or one file per message under raw_messages/"
+    )
+    parser.add_argument(
+        "--compression", choices=COMPRESSIONS,
+        help="compression of the sqlite and pack body stores"
+    )
+    parser.add_argument(
+        "--parse-mode", choices=PARSE_MODES,
+        help="defaults to the last run's choice or bytes"
+    )
+    instrument.add_arguments(parser)
+    return parser.parse_args()
+
+
+def ingest(conn, paths=(MBOX_PATH,), workers=1, incremental=False,
+           body_store=None, compression=None, parse_mode=None):
+    tune_for_bulk_load(conn)
+    create_tables(conn)
+    saved_kind, saved_compression = get_body_store_settings(conn)
+    kind = body_store or saved_kind
+    compression = compression or saved_compression
+    store = open_body_store(conn, kind, compression)
+    saved_parse_mode = get_parse_mode(conn)
+    parse_mode = parse_mode or saved_parse_mode or 'bytes'
+
+    searchable = has_search_table(conn)
+    if not searchable:
+        instrument.log("SQLite was built without FTS5, messages_fts won't be filled")
+    starts = None
+    if incremental:
+        if not has_messages(conn):
+            instrument.log("No checkpoint for the mboxes, loading from scratch")
+        elif (kind, compression) != (saved_kind, saved_compression):
+            instrument.log("The body store changed, rebuilding from scratch")
+        elif parse_mode != (saved_parse_mode or 'text'):
+            # Databases loaded before there was a choice were parsed as text,
+            # a new one has none of either
+            instrument.log("The parse mode changed, rebuilding from scratch")
+        elif get_fixups_fingerprint(conn) != fixups_fingerprint():
+            instrument.log("The fix-up rules changed, rebuilding from scratch")
+        elif searchable and not search_table_is_complete(conn):
+            instrument.log("messages_fts is missing messages, rebuilding from scratch")
+        elif searchable and get_search_table_version(conn) != SEARCH_TABLE_VERSION:
+            instrument.log("messages_fts was filled by an older version, rebuilding from scratch")
+        elif not authors_are_complete(conn):
+            instrument.log("authors is missing messages, rebuilding from scratch")
+        else:
+            starts = find_resume_offsets(conn, paths)
+            if starts is None:
+                instrument.log("No usable checkpoint for the mboxes, rebuilding from scratch")
+    if starts is None:
+        clean_the_slate(conn, store)
+        save_ingest_settings(conn, kind, compression, parse_mode)
+        starts = {}
+    inserted = 0
+    with instrument.stage('load'):
+        known = load_known_messages(conn)
+        messages = get_messages(paths, workers=workers, starts=starts,
+                                parse_mode=parse_mode, known=known)
+        for batch in batched(messages, INSERT_BATCH_SIZE):
+            instrument.count('messages', len(batch))
+            instrument.count('bytes', sum(message._mbox_length for message in batch))
+            for message in batch:
+                for name in apply_fixups(message):
+                    instrument.count(name)
+            new_messages = insert_into_db(conn, batch)
+            add_to_authors(conn, new_messages)
+            if searchable:
+                index_for_search(conn, new_messages)
+            for message in new_messages:
+                write_message_to_file(store, message)
+            inserted += len(new_messages)
+        conn.commit()
+        create_indexes(conn)
+        save_checkpoints(conn, known.last_read)
+        instrument.count('new_messages', inserted)
+        instrument.count('duplicates', known.duplicates)
+    instrument.log(f"Inserted {inserted} new messages, skipped {known.duplicates} duplicates")
+    store.close()
+    with instrument.stage('update_threads'):
+        update_threads(conn)
+
+
 def main():
-    conn = sqlite3.connect('database.db')
-    clean_the_slate(conn)
-    for message in get_messages():
-        insert_into_db(conn, message)
-        write_message_to_file(message)
-    conn.commit()
-    mark_replies_with_no_parent(conn)
-    fix_weird_1999_dates_between_92_and_97(conn)
-    fix_genuine_1999_dates(conn)
-    calculate_thread_roots(conn)
+    args = parse_args()
+    instrument.configure(args)
+    conn = instrument.connect('database.db')
+    with instrument.stage('parser'):
+        ingest(
+            conn,
+            expand_mbox_paths(args.mboxes),
+            workers=args.workers or os.cpu_count(),
+            incremental=args.incremental,
+            body_store=args.body_store,
+            compression=args.compression,
+            parse_mode=args.parse_mode
+        )
     conn.close()
+    instrument.finish(args)
 
 
 if __name__ == "__main__":
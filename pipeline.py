@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+import argparse
+import hashlib
+import json
+import os
+
+import instrument
+from body_store import BODY_STORES, COMPRESSIONS
+from parser import MBOX_PATH, PARSE_MODES, expand_mbox_paths, ingest
+from build_json_tree import build_month_threads, write_months
+from build_json_tree import clean_the_slate as clean_json_months
+from build_author_index import build_authors, write_authors
+from build_author_index import clean_the_slate as clean_json_authors
+from intermediate import FORMATS
+from build_search_index import SEARCH_INDEX_DIR, build_search_index
+from make_markdown_files import MANIFEST_PATH, render
+
+
+# Runs parser.py, build_json_tree.py, build_author_index.py,
+# make_markdown_files.py and build_search_index.py in one process, handing
+# the month threads and the authors to the renderer in memory. The
+# json_months and json_authors files are only written with --json.
+
+STATE_PATH = "pipeline_state.json"
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_ingest(conn, args, values):
+    ingest(
+        conn,
+        args.mbox_paths,
+        workers=args.workers,
+        incremental=True,
+        body_store=args.body_store,
+        compression=args.compression,
+        parse_mode=args.parse_mode
+    )
+
+
+def run_threads(conn, args, values):
+    # The files of an earlier --json run are removed even without --json,
+    # so make_markdown_files.py never renders from out of date ones
+    months = build_month_threads(conn)
+    clean_json_months()
+    if args.json:
+        write_months(months, args.json)
+    return months
+
+
+def run_authors(conn, args, values):
+    authors = build_authors(conn)
+    clean_json_authors()
+    if args.json:
+        write_authors(authors, args.json)
+    return authors
+
+
+def run_render(conn, args, values):
+    render(conn, values['threads'], values['authors'], args.workers)
+
+
+def run_search(conn, args, values):
+    build_search_index(conn)
+
+
+# Each stage lists the stages it depends on, the files (and the options
+# holding lists of files) and code it reads and the files it writes. A stage
+# is skipped when none of that changed since it last ran, unless a stage that
+# needs its in memory result has to run, or --json asks for the files of a
+# stage that writes_json.
+STAGES = [
+    {
+        'name': 'ingest',
+        'after': [],
+        'files': [],
+        'file_options': ['mbox_paths'],
+        'code': ['parser.py', 'mbox.py', 'shared.py', 'thread_engine.py',
+                 'body_store.py', 'output_sink.py', 'fixups.py'],
+        'options': ['body_store', 'compression', 'parse_mode'],
+        'outputs': ['database.db'],
+        'run': run_ingest,
+    },
+    {
+        'name': 'threads',
+        'after': ['ingest'],
+        'files': [],
+        'code': ['build_json_tree.py', 'intermediate.py', 'model.py'],
+        'options': [],
+        'outputs': [],
+        'writes_json': True,
+        'run': run_threads,
+    },
+    {
+        'name': 'authors',
+        'after': ['ingest'],
+        'files': [],
+        'code': ['build_author_index.py', 'intermediate.py'],
+        'options': [],
+        'outputs': [],
+        'writes_json': True,
+        'run': run_authors,
+    },
+    {
+        'name': 'render',
+        'after': ['ingest', 'threads', 'authors'],
+        'files': [],
+        'code': ['make_markdown_files.py', 'shared.py', 'body_store.py',
+                 'output_sink.py', 'model.py'],
+        'options': [],
+        'outputs': [MANIFEST_PATH],
+        'run': run_render,
+    },
+    {
+        'name': 'search',
+        'after': ['ingest'],
+        'files': [],
+        'code': ['build_search_index.py', 'output_sink.py'],
+        'options': [],
+        'outputs': [f'{SEARCH_INDEX_DIR}/index.json'],
+        'run': run_search,
+    },
+]
+
+
+def stat_file(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def fingerprint_stage(stage, args, fingerprints):
+    m = hashlib.sha256(stage['name'].encode())
+    for path in stage['code']:
+        with open(os.path.join(CODE_DIR, path), 'rb') as f:
+            m.update(f.read())
+    files = list(stage['files'])
+    for option in stage.get('file_options', []):
+        files.extend(getattr(args, option))
+    for path in files:
+        m.update(json.dumps([path, stat_file(path)]).encode())
+    for name in stage['after']:
+        m.update(fingerprints[name].encode())
+    for option in stage['options']:
+        m.update(json.dumps([option, getattr(args, option)]).encode())
+    return m.hexdigest()
+
+
+def is_current(stage, fingerprint, state):
+    previous = state.get(stage['name'])
+    if not previous or previous['inputs'] != fingerprint:
+        return False
+    # Outputs changed or removed outside the pipeline
+    return all(
+        stat_file(path) == previous['outputs'].get(path)
+        for path in stage['outputs']
+    )
+
+
+def plan_stages(args, state):
+    # Returns the fingerprints of every stage and the names of those to run
+    fingerprints = {}
+    for stage in STAGES:
+        fingerprints[stage['name']] = fingerprint_stage(stage, args, fingerprints)
+    to_run = set()
+    for stage in reversed(STAGES):
+        needed_in_memory = not stage['outputs'] and any(
+            stage['name'] in later['after'] and later['name'] in to_run
+            for later in STAGES
+        )
+        forced = args.force or (args.json and stage.get('writes_json'))
+        if forced or needed_in_memory or not is_current(
+            stage, fingerprints[stage['name']], state
+        ):
+            to_run.add(stage['name'])
+    return fingerprints, to_run
+
+
+def load_state():
+    try:
+        with open(STATE_PATH) as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(state):
+    with open(STATE_PATH, 'w') as o:
+        o.write(json.dumps(state, sort_keys=True))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run every stage from the mbox to the Markdown pages"
+    )
+    parser.add_argument(
+        "mboxes", nargs="*", default=[MBOX_PATH],
+        help="passed on to parser.py"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="processes used to parse and render, 0 for one per CPU"
+    )
+    parser.add_argument(
+        "--body-store", choices=BODY_STORES,
+        help="passed on to parser.py"
+    )
+    parser.add_argument(
+        "--compression", choices=COMPRESSIONS,
+        help="passed on to parser.py"
+    )
+    parser.add_argument(
+        "--parse-mode", choices=PARSE_MODES,
+        help="passed on to parser.py"
+    )
+    parser.add_argument(
+        "--json", nargs="?", const="jsonl", choices=FORMATS,
+        help="also write json_months/ and json_authors/, as jsonl by default"
+    )
+    parser.add_argument(
+        "--force", action="store_true",
+        help="run every stage, even those that are up to date"
+    )
+    instrument.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    instrument.configure(args)
+    args.workers = args.workers or os.cpu_count()
+    args.mbox_paths = expand_mbox_paths(args.mboxes)
+    state = load_state()
+    fingerprints, to_run = plan_stages(args, state)
+    conn = instrument.connect('database.db')
+    values = {}
+    for stage in STAGES:
+        if stage['name'] not in to_run:
+            instrument.log(f"{stage['name']}: up to date")
+            continue
+        instrument.log(f"{stage['name']}: running")
+        with instrument.stage(stage['name']):
+            values[stage['name']] = stage['run'](conn, args, values)
+        conn.commit()
+        state[stage['name']] = {
+            'inputs': fingerprints[stage['name']],
+            'outputs': {path: stat_file(path) for path in stage['outputs']},
+        }
+        save_state(state)
+    conn.close()
+    instrument.finish(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,46 @@
 #!/usr/bin/env python
-import sqlite3
+import argparse
 import re
+
+import instrument
 from shared import make_id_from_email
 
 
+# parser.py fills in sender_id as it inserts messages, this only catches up
+# rows loaded before it did
+
+
 def get_authors(cursor):
-    sql = "SELECT `message_hash`, `from` FROM `messages`;"
+    sql = "SELECT `message_hash`, `from` FROM `messages` WHERE `sender_id` IS NULL;"
     for row in cursor.execute(sql):
         yield row[0], row[1]
 
 
-def set_sender_id(conn, message_hash, sender_id):
+def set_sender_ids(conn, authors):
     cursor = conn.cursor()
     sql = "UPDATE `messages` SET `sender_id` = ? WHERE `message_hash` = ?;"
-    cursor.execute(sql, [sender_id, message_hash])
+    cursor.executemany(sql, [
+        [make_id_from_email(email), message_hash]
+        for message_hash, email in authors
+    ])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fill in missing sender_ids")
+    instrument.add_arguments(parser)
+    return parser.parse_args()
 
 
 def main():
-    conn = sqlite3.connect('database.db')
+    args = parse_args()
+    instrument.configure(args)
+    conn = instrument.connect('database.db')
     cursor = conn.cursor()
-    for message_hash, email in get_authors(cursor):
-        set_sender_id(conn, message_hash, make_id_from_email(email))
-    conn.commit()
+    with instrument.stage('set_author_ids'):
+        set_sender_ids(conn, list(get_authors(cursor)))
+        conn.commit()
+    conn.close()
+    instrument.finish(args)
 
 
 if __name__ == "__main__":
@@ -1,40 +1,59 @@
 import re
+from functools import lru_cache
 
 
-def mask_all_emails(text):
+email_regex = re.compile(r"[A-Za-z0-9\.\-+_]+@[A-Za-z0-9\.\-+_]+\.[A-Za-z]+")
+bracketed_email_regex = re.compile('<(.+)>')
+named_email_regex = re.compile('(.*)<(.+)>')
+id_separators_regex = re.compile(r'[<>\(\)\.\s]+')
+non_word_regex = re.compile(r'\W+')
 
-    emails = sorted(re.findall(r"[A-Za-z0-9\.\-+_]+@[A-Za-z0-9\.\-+_]+\.[A-Za-z]+", text), key=len)
-    if emails:
-        emails = list(set(emails))
-        emails.reverse()
-    # @TODO add whitelist?
-    replacements = []
-    for email in emails:
-        text = text.replace(email, mask_email(email))
+# Addresses, or whole domains written as "@example.com", that are safe to
+# publish unmasked. Compared lower case.
+MASK_WHITELIST = frozenset()
 
-    return text
 
+def mask_all_emails(text, whitelist=MASK_WHITELIST):
+    # One pass over the text, the masked forms come from mask_email's cache
+    if whitelist:
+        return email_regex.sub(
+            lambda match: mask_unless_whitelisted(match.group(0), whitelist),
+            text
+        )
+    return email_regex.sub(lambda match: mask_email(match.group(0)), text)
+
+
+def mask_unless_whitelisted(email, whitelist):
+    lowered = email.lower()
+    if lowered in whitelist or lowered[lowered.index('@'):] in whitelist:
+        return email
+    return mask_email(email)
+
+
+@lru_cache(maxsize=65536)
 def mask_email(email):
     user, domain = email.split('@', 2)
     user = user[0:2] + "***" + user[-1]
     return f"{user}@{domain}"
 
 
+@lru_cache(maxsize=65536)
 def make_id_from_email(email):
     if '<' in email:
-        email = re.search('<(.+)>', email).group(1)
+        email = bracketed_email_regex.search(email).group(1)
     email = mask_email(email).replace('*', '_')
     email = str(email).replace('@', '_at_')
-    email = re.sub('[<>\(\)\.\s]+', '_', email)
-    email = re.sub('\W+', '', email)
-    return email.lower()    
+    email = id_separators_regex.sub('_', email)
+    email = non_word_regex.sub('', email)
+    return email.lower()
 
 
+@lru_cache(maxsize=65536)
 def mask_from(from_text, replace_at='<span>@</span>'):
     if '<' in from_text:
-        parts = re.search('(.*)<(.+)>', from_text)
+        parts = named_email_regex.search(from_text)
         name = parts.group(1)
         email = mask_email(parts.group(2)).replace('@', replace_at)
         return f"{name}<{email}>"
     return mask_email(from_text).replace('@', replace_at)
-    
\ No newline at end of file
+
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+import argparse
+import random
+from datetime import datetime, timedelta
+
+
+# Writes a made up mbox shaped like grasehotspot/topics.mbox, for measuring
+# the pipeline without the real archive. The same options and seed always
+# give the same file.
+
+MONTH_NAMES = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep",
+               "Oct", "Nov", "Dec"]
+DAY_NAMES = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+ZONES = ["+0000", "-0800", "-0500", "+1000", "+0530", "+0200"]
+
+
+def make_authors(count):
+    authors = []
+    for i in range(count):
+        email = "user{}.{}@example{}.com".format(i, i * 7 % 13, i % 5)
+        if i % 4:
+            authors.append((f"Person {i} <{email}>", email))
+        else:
+            authors.append((email, email))
+    return authors
+
+
+def format_date(rng, date):
+    day = DAY_NAMES[date.weekday()]
+    month = MONTH_NAMES[date.month - 1]
+    zone = rng.choice(ZONES)
+    text = "{}, {} {} {} {:%H:%M:%S} {}".format(
+        day, date.day, month, date.year, date, zone
+    )
+    if zone == "-0800" and rng.random() < 0.5:
+        text += " (PST)"
+    return text
+
+
+def format_malformed_date(rng, date):
+    # Dates the fast path in parser.parse_date passes on to dateutil and its
+    # fallbacks
+    day = DAY_NAMES[date.weekday()]
+    month = MONTH_NAMES[date.month - 1]
+    kind = rng.randrange(6)
+    if kind == 0:
+        return "Received SMTPSun, {} {} {} {:%H:%M:%S} -0400 for karn@example.com".format(
+            date.day, month, date.year, date
+        )
+    if kind == 1:
+        return "{}, {} {} {} {:%H:%M:%S} {}".format(
+            day, date.day, month, date.year, date, rng.choice(["pdt", "est", "PPE"])
+        )
+    if kind == 2:
+        return "{} {} {:%y %H:%M} +0100".format(date.day, month, date)
+    if kind == 3:
+        return "{:%Y-%m-%d %H:%M:%S}".format(date)
+    if kind == 4:
+        return "{},  {:02d} {} {} {:%H:%M:%S} GMT".format(
+            day, date.day, month, date.year, date
+        )
+    return "{}, {} {} 1999 {:%H:%M:%S} +0000".format(day, date.day, month, date)
+
+
+def make_body(rng, authors, body_lines):
+    lines = [
+        "Hello,",
+        "",
+        "Write to {} or {} about it.".format(
+            rng.choice(authors)[1], rng.choice(authors)[1]
+        ),
+        "café naïve",
+    ]
+    for i in range(rng.randint(*body_lines)):
+        lines.append("> line {} from {}, {}".format(
+            i, rng.choice(authors)[1], "lorem ipsum " * rng.randint(1, 6)
+        ))
+    lines.append("From the desk of nobody")
+    return "\n".join(lines) + "\n"
+
+
+def generate_messages(messages=1000, seed=1, authors=50, thread_depth=6,
+                      fan_out=4, new_thread_rate=0.3, body_lines=(0, 20),
+                      duplicate_rate=0.02, orphan_rate=0.02,
+                      malformed_date_rate=0.05, start=datetime(2008, 1, 1)):
+    # Yields each message as mbox text. Replies pick a parent from the recent
+    # messages that are shallower than thread_depth and have fewer than
+    # fan_out replies.
+    rng = random.Random(seed)
+    people = make_authors(authors)
+    date = start
+    message_ids = []
+    seen_ids = set()
+    open_parents = []
+    depths = {}
+    replies = {}
+    subjects = {}
+    for i in range(messages):
+        date += timedelta(minutes=rng.randint(1, 600))
+        from_header, _ = rng.choice(people)
+        message_id = f"<msg{i}.{rng.randrange(10 ** 6)}@example.com>"
+        headers = []
+        if message_ids and rng.random() < malformed_date_rate:
+            headers.append("Date: " + format_malformed_date(rng, date))
+        else:
+            headers.append("Date: " + format_date(rng, date))
+        subject = f"Topic {i}"
+        roll = rng.random()
+        if message_ids and roll < duplicate_rate:
+            message_id = rng.choice(message_ids)
+        elif message_ids and roll < duplicate_rate + orphan_rate:
+            headers.append(f"In-Reply-To: <missing{i}@example.com>")
+            subject = "Re: " + subject
+        elif open_parents and rng.random() > new_thread_rate:
+            parent = rng.choice(open_parents)
+            headers.append(f"In-Reply-To: {parent}")
+            subject = "Re: " + subjects[parent]
+            depths[message_id] = depths[parent] + 1
+            replies[parent] = replies.get(parent, 0) + 1
+            if replies[parent] >= fan_out:
+                open_parents.remove(parent)
+        if message_id not in depths:
+            depths[message_id] = 0
+        if message_id not in seen_ids and depths[message_id] < thread_depth:
+            open_parents.append(message_id)
+            open_parents = open_parents[-50:]
+        if message_id not in subjects:
+            subjects[message_id] = subject.replace("Re: ", "")
+        seen_ids.add(message_id)
+        message_ids.append(message_id)
+        headers += [
+            f"Message-ID: {message_id}",
+            f"From: {from_header}",
+            "To: list@googlegroups.com",
+            f"Subject: {subject}",
+            "MIME-Version: 1.0",
+            "Content-Type: text/plain; charset=UTF-8",
+            "Content-Transfer-Encoding: 8bit",
+        ]
+        yield "From {}@xxx Mon Jan 01 00:00:00 +0000 2011\n{}\n\n{}".format(
+            1000000 + i, "\n".join(headers), make_body(rng, people, body_lines)
+        )
+
+
+def write_mbox(path, **options):
+    with open(path, "w") as o:
+        for message in generate_messages(**options):
+            o.write(message)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Write a synthetic mbox")
+    parser.add_argument("path", help="mbox to write")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--authors", type=int, default=50)
+    parser.add_argument("--thread-depth", type=int, default=6)
+    parser.add_argument("--fan-out", type=int, default=4)
+    parser.add_argument("--new-thread-rate", type=float, default=0.3)
+    parser.add_argument(
+        "--body-lines", type=int, nargs=2, default=(0, 20),
+        metavar=("MIN", "MAX"), help="quoted lines added to each body"
+    )
+    parser.add_argument("--duplicate-rate", type=float, default=0.02)
+    parser.add_argument("--orphan-rate", type=float, default=0.02)
+    parser.add_argument("--malformed-date-rate", type=float, default=0.05)
+    return parser.parse_args()
+
+
+def main():
+    options = vars(parse_args())
+    path = options.pop("path")
+    options["body_lines"] = tuple(options["body_lines"])
+    write_mbox(path, **options)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+import argparse
+from collections import Counter
+
+import instrument
+
+
+def get_links(conn):
+    sql = """
+        SELECT
+            `message_hash`,
+            `message_id`,
+            `reply_to`,
+            `thread_root`,
+            `no_parent`
+        FROM
+            `messages`;
+    """
+    return conn.cursor().execute(sql).fetchall()
+
+
+def resolve_threads(links):
+    # Returns {message_hash: (thread_root, no_parent)}.
+    # A reply is an orphan (no_parent = 1) when its reply_to matches no
+    # message_id, or more than one; orphans and non-replies root their own
+    # thread. Everything else inherits its parent's root, except replies
+    # caught in a reply_to cycle, which are left without one.
+    id_counts = Counter(message_id for _, message_id, _, _, _ in links)
+    parents = {}
+    no_parent = {}
+    for message_hash, message_id, _, _, _ in links:
+        if id_counts[message_id] == 1:
+            parents[message_id] = message_hash
+    reply_tos = {}
+    for message_hash, message_id, reply_to, _, _ in links:
+        reply_tos[message_hash] = reply_to
+        if reply_to is not None and id_counts[reply_to] != 1:
+            no_parent[message_hash] = 1
+
+    roots = {}
+    for message_hash in reply_tos:
+        path = []
+        on_path = set()
+        current = message_hash
+        while current not in roots:
+            reply_to = reply_tos[current]
+            if reply_to is None or current in no_parent:
+                roots[current] = current
+                break
+            if current in on_path:
+                roots[current] = None
+                break
+            path.append(current)
+            on_path.add(current)
+            current = parents[reply_to]
+        root = roots[current]
+        for walked in path:
+            roots[walked] = root
+    return {
+        message_hash: (roots[message_hash], no_parent.get(message_hash))
+        for message_hash in reply_tos
+    }
+
+
+def update_threads(conn):
+    links = get_links(conn)
+    threads = resolve_threads(links)
+    changes = []
+    for message_hash, _, _, thread_root, no_parent in links:
+        resolved = threads[message_hash]
+        if resolved != (thread_root, no_parent):
+            changes.append([resolved[0], resolved[1], message_hash])
+    sql = """
+        UPDATE
+            `messages`
+        SET
+            `thread_root` = ?,
+            `no_parent` = ?
+        WHERE
+            `message_hash` = ?;
+    """
+    conn.cursor().executemany(sql, changes)
+    conn.commit()
+    instrument.log(f"Threaded {len(links)} messages, updated {len(changes)}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Work out thread roots")
+    instrument.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    instrument.configure(args)
+    conn = instrument.connect('database.db')
+    with instrument.stage('thread_engine'):
+        update_threads(conn)
+    conn.close()
+    instrument.finish(args)
+
+
+if __name__ == "__main__":
+    main()